@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+"""
+Benchmarks the doorstop_cli.py backend on an existing doorstop tree, or on a
+generated tree of a given size. Reports the time and resident memory of
+loading full doorstop objects versus the compact item records, and the
+latency of the read queries that the plugin runs most, with the subprocess
+backend and with the in-process backend.
+
+    python benchmark.py --generate 50000
+    python benchmark.py --root /path/to/project
+"""
+
+import argparse
+import io
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import doorstop_cli
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+CLI = os.path.join(os.path.dirname(os.path.abspath(__file__)), "doorstop_cli.py")
+
+
+def max_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def generate_tree(root, count):
+    """
+    Generates a tree with three documents (REQ <- SPC <- TST) of about count
+    items in total, where each item links to a parent and references code.
+    """
+    documents = [("REQ", None), ("SPC", "REQ"), ("TST", "SPC")]
+    per_document = max(1, count // len(documents))
+    os.makedirs(os.path.join(root, "src"))
+    for number in range(100):
+        with open(os.path.join(root, "src", "module{}.py".format(number)), "w") as fh:
+            fh.write(
+                "\n".join("def function{}():\n    pass\n".format(i) for i in range(50))
+            )
+
+    for prefix, parent in documents:
+        folder = os.path.join(root, "docs", prefix.lower())
+        os.makedirs(folder)
+        with open(os.path.join(folder, doorstop_cli.CONFIG), "w") as fh:
+            fh.write("settings:\n  digits: 5\n  prefix: {}\n  sep: ''\n".format(prefix))
+            if parent:
+                fh.write("  parent: {}\n".format(parent))
+        for number in range(1, per_document + 1):
+            uid = "{}{:05d}".format(prefix, number)
+            lines = [
+                "active: true",
+                "derived: false",
+                "header: ''",
+                "level: 1.{}".format(number),
+                "links:",
+            ]
+            if parent:
+                lines.append("- {}{:05d}: null".format(parent, number))
+            else:
+                lines[-1] += " []"
+            lines += [
+                "normative: true",
+                "ref: ''",
+                "references:",
+                "- keyword: 'def function{}():'".format(number % 50),
+                "  path: src/module{}.py".format(number % 100),
+                "  type: file",
+                "reviewed: null",
+                "text: |",
+                "  Generated item {}".format(uid),
+            ]
+            with open(os.path.join(folder, uid + ".yml"), "w") as fh:
+                fh.write("\n".join(lines) + "\n")
+
+
+def measure(root, mode):
+    """
+    Loads the tree in this process and prints the load time and resident
+    memory. Run in a separate process per mode, so that the numbers don't
+    influence each other.
+    """
+    before = max_rss_mb()
+    start = time.perf_counter()
+    if mode == "doorstop":
+        doorstop = doorstop_cli.import_doorstop()
+        tree = doorstop.build(root=root)
+        items = []
+        for document in tree:
+            for item in document:
+                # Touch the fields the plugin needs, so they are loaded
+                item.header, item.text, item.links, item.references
+                items.append(item)
+        count = len(items)
+    else:
+        if mode == "index-cold":
+            shutil.rmtree(os.path.dirname(doorstop_cli.cache_path(root, "x")))
+        index = doorstop_cli.Index.load(root)
+        count = len(index.records)
+    duration = time.perf_counter() - start
+    print(
+        json.dumps(
+            {
+                "items": count,
+                "seconds": duration,
+                "rss_before": before,
+                "rss_after": max_rss_mb(),
+            }
+        )
+    )
+
+
+def run_measure(root, mode):
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), "--root", root, "--measure", mode]
+    )
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def time_query(root, args, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.check_output([sys.executable, CLI, "--root", root] + args)
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def time_query_in_process(root, args, repeat):
+    """
+    Like time_query, but runs the command in this process like the
+    in-process backend of the plugin does.
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        doorstop_cli.main(["--root", root] + args, io.StringIO())
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def format_mb(value):
+    return "n/a" if value is None else "{:.1f} MB".format(value)
+
+
+def benchmark(root, repeat):
+    print("Loading all items of {}".format(root))
+    print(
+        "{:<12} {:>8} {:>10} {:>12} {:>12}".format(
+            "mode", "items", "seconds", "rss before", "rss after"
+        )
+    )
+    for mode in ("doorstop", "index-cold", "index-warm"):
+        result = run_measure(root, mode)
+        print(
+            "{:<12} {:>8} {:>10.3f} {:>12} {:>12}".format(
+                mode,
+                result["items"],
+                result["seconds"],
+                format_mb(result["rss_before"]),
+                format_mb(result["rss_after"]),
+            )
+        )
+
+    index = doorstop_cli.Index.load(root)
+    record = next(iter(index), None)
+    if record is None:
+        return
+    reference = record.references[0][0] if record.references else "none"
+    queries = [
+        ["documents"],
+        ["items", "--prefix", record.prefix],
+        ["item", record.uid],
+        ["parents", "--item", record.uid],
+        ["children", "--item", record.uid],
+        ["linked", "--item", record.uid],
+        ["find_references", reference],
+    ]
+    print()
+    print("Median latency of queries ({} runs)".format(repeat))
+    print("{:<40} {:>12} {:>12}".format("query", "subprocess", "in process"))
+    for query in queries:
+        print(
+            "{:<40} {:>10.3f} s {:>10.3f} s".format(
+                " ".join(query),
+                time_query(root, query, repeat),
+                time_query_in_process(root, query, repeat),
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--root", action="store", type=str, help="root of doorstop tree"
+    )
+    parser.add_argument(
+        "--generate",
+        action="store",
+        type=int,
+        help="generate a tree with this number of items to benchmark",
+    )
+    parser.add_argument(
+        "--repeat", action="store", type=int, default=5, help="runs per query"
+    )
+    parser.add_argument("--measure", action="store", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.root, args.measure)
+    elif args.generate:
+        root = tempfile.mkdtemp(prefix="doorstop-benchmark-")
+        try:
+            generate_tree(root, args.generate)
+            benchmark(root, args.repeat)
+        finally:
+            shutil.rmtree(root)
+    else:
+        benchmark(args.root or ".", args.repeat)
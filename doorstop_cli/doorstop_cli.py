@@ -1,15 +1,75 @@
 #!/usr/bin/env python
 import json
+import hashlib
 import logging
 import argparse
+import bisect
+import csv
+import glob
+import io
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import doorstop
+import yaml
 
+logger = logging.getLogger("DoorstopPlugin")
 
-doorstop.settings.ADDREMOVE_FILES = False
+CONFIG = ".doorstop.yml"
+SKIP = ".doorstop.skip"
+SKIP_ALL = ".doorstop.skip-all"
+EXCLUDE_DIRNAMES = {".git", ".tox", ".venv", "venv"}
+ITEM_EXTENSIONS = (".yml",)
 
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
-logger = logging.getLogger("DoorstopPlugin")
+# Bump when the format of the cached item records changes
+INDEX_VERSION = 2
+
+# Number of roots of which a long running process (see serve, and the
+# in-process backend of the plugin) keeps the loaded index in memory
+RESIDENT_INDEXES = 3
+
+# Layout of the binary index file that the plugin host maps into memory,
+# all little endian. Strings are (offset, length) pairs of UTF-8 bytes in
+# the string section. Items are sorted by uid, paths by path, so both can
+# be binary searched. DoorstopIndexFile in doorstop_util reads the file
+# with these structs, imported from this module.
+INDEX_FILE = "index.bin"
+INDEX_MAGIC = b"DSIX"
+INDEX_FILE_VERSION = 1
+# magic, version, item count, path count and the offsets of the
+# item, link, path, reference and string sections
+INDEX_HEADER = struct.Struct("<4sIIIIIIII")
+# uid, path, text, first link, link count
+INDEX_ITEM = struct.Struct("<IIIIIIII")
+# uid
+INDEX_LINK = struct.Struct("<II")
+# path, first reference, reference count
+INDEX_PATH = struct.Struct("<IIII")
+# item number, keyword (length NO_KEYWORD when the reference has none)
+INDEX_REFERENCE = struct.Struct("<III")
+NO_KEYWORD = 0xFFFFFFFF
+
+# Number of referenced files of which a long running process keeps the
+# keyword index in memory
+RESIDENT_KEYWORD_FILES = 64
+
+
+def import_doorstop():
+    """
+    Imports doorstop. Only needed for writes: all read queries work on the
+    compact item records of the Index, so they don't pay for the import.
+    """
+    import doorstop
+
+    doorstop.settings.ADDREMOVE_FILES = False
+    return doorstop
 
 
 def item_to_dict(item):
@@ -20,120 +80,1802 @@ def item_to_dict(item):
     }
 
 
+def cache_path(root, name):
+    """
+    Returns the path of the cache file with the given name for the
+    doorstop tree at root. Cache files live outside of the project.
+    """
+    digest = hashlib.sha1(os.path.abspath(root).encode("utf-8")).hexdigest()[:16]
+    folder = os.path.join(tempfile.gettempdir(), "sublime-doorstop", digest)
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, name)
+
+
+def load_cache(root, name):
+    try:
+        with open(cache_path(root, name), mode="r", encoding="utf-8") as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def save_cache(root, name, data):
+    path = cache_path(root, name)
+    tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp_path, mode="w", encoding="utf-8") as fh:
+            json.dump(data, fh)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("Could not write cache {}: {}".format(path, e))
+
+
+def file_stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _dir_stamp(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _scan_documents(root):
+    """
+    Walks root the same way `doorstop.build` does, but only reads the
+    settings of each document instead of loading all of its items. Also
+    returns the modification times of the walked directories, which
+    change when a document config is added to or removed from them.
+    """
+    documents = {}
+    configs = {}
+    dirs = {".": _dir_stamp(root)}
+    if os.path.isfile(os.path.join(root, SKIP_ALL)):
+        return documents, configs, dirs
+
+    def add(path):
+        config = os.path.join(path, CONFIG)
+        if not os.path.isfile(config) or os.path.isfile(os.path.join(path, SKIP)):
+            return
+        with open(config, mode="r", encoding="utf-8") as fh:
+            data = yaml.load(fh, Loader=YamlLoader) or {}
+        sets = data.get("settings", {})
+        relpath = os.path.relpath(path, root)
+        configs[relpath] = file_stamp(config)
+        documents[str(sets.get("prefix", "REQ"))] = {
+            "path": relpath,
+            "parent": str(sets["parent"]).strip() if sets.get("parent") else None,
+            "sep": str(sets.get("sep", "")).strip(),
+        }
+
+    add(root)
+    for dirpath, dirnames, _ in os.walk(root, topdown=True):
+        whitelist = []
+        for dirname in dirnames:
+            if dirname in EXCLUDE_DIRNAMES:
+                continue
+            path = os.path.join(dirpath, dirname)
+            dirs[os.path.relpath(path, root)] = _dir_stamp(path)
+            if os.path.isfile(os.path.join(path, SKIP_ALL)):
+                continue
+            whitelist.append(dirname)
+            add(path)
+        dirnames[:] = whitelist
+    return documents, configs, dirs
+
+
+def document_hierarchy(root, refresh=False):
+    """
+    Returns a dict of prefix -> {"path", "parent", "sep"} for all documents
+    in the tree, with paths relative to root. The result is cached between
+    runs and only rebuilt when one of the known document configs changed,
+    or when one of the walked directories changed, which is the case when
+    a document was added or removed.
+    """
+    return _document_hierarchy(root, refresh)[0]
+
+
+def _document_hierarchy(root, refresh=False):
+    """
+    Like document_hierarchy, but also returns the modification times of
+    the walked directories, which were checked when it returns.
+    """
+    cached = None if refresh else load_cache(root, "documents.json")
+    if cached and "dirs" in cached:
+        if all(
+            file_stamp(os.path.join(root, path, CONFIG)) == stamp
+            for path, stamp in cached["configs"].items()
+        ) and all(
+            _dir_stamp(os.path.join(root, path)) == stamp
+            for path, stamp in cached["dirs"].items()
+        ):
+            return cached["documents"], cached["dirs"]
+
+    documents, configs, dirs = _scan_documents(root)
+    save_cache(
+        root,
+        "documents.json",
+        {"documents": documents, "configs": configs, "dirs": dirs},
+    )
+    return documents, dirs
+
+
+def document_ancestors(root, prefix):
+    """
+    Returns the prefixes of the document with the given prefix and of all
+    of its parent documents, starting with the document itself.
+    """
+    hierarchy = document_hierarchy(root)
+    if prefix not in hierarchy:
+        hierarchy = document_hierarchy(root, refresh=True)
+
+    result = []
+    while prefix and prefix not in result:
+        result.append(prefix)
+        prefix = hierarchy.get(prefix, {}).get("parent")
+    return result
+
+
+def _document_folder(root, document):
+    # Same paths as the ones doorstop (and the Index) report
+    return root if document["path"] == "." else os.path.join(root, document["path"])
+
+
+def _locate_item(root, hierarchy, uid):
+    """
+    Returns (prefix, path) for the item file of uid, or None when the uid
+    can't be matched to exactly one item file.
+    """
+    candidates = [
+        prefix
+        for prefix, document in hierarchy.items()
+        if uid.lower().startswith((prefix + document["sep"]).lower())
+    ]
+    found = []
+    for prefix in candidates:
+        folder = _document_folder(root, hierarchy[prefix])
+        for extension in ITEM_EXTENSIONS:
+            path = os.path.join(folder, uid + extension)
+            if os.path.isfile(path):
+                found.append((prefix, path))
+
+    if not found:
+        # Items may also be stored in sub folders of a document
+        names = {uid + extension for extension in ITEM_EXTENSIONS}
+        for prefix in candidates:
+            folder = _document_folder(root, hierarchy[prefix])
+            for dirpath, dirnames, filenames in os.walk(folder):
+                dirnames[:] = [
+                    dirname
+                    for dirname in dirnames
+                    if not os.path.isfile(os.path.join(dirpath, dirname, CONFIG))
+                ]
+                found.extend(
+                    (prefix, os.path.join(dirpath, filename))
+                    for filename in filenames
+                    if filename in names
+                )
+
+    if len(found) != 1:
+        return None
+    return found[0]
+
+
+def locate_item(root, uid):
+    location = _locate_item(root, document_hierarchy(root), uid)
+    if location is None:
+        location = _locate_item(root, document_hierarchy(root, refresh=True), uid)
+    return location
+
+
+def load_document(root, prefix):
+    """
+    Loads a single document without building the whole tree.
+    Returns None if the prefix is unknown.
+    """
+    hierarchy = document_hierarchy(root)
+    if prefix not in hierarchy:
+        hierarchy = document_hierarchy(root, refresh=True)
+    if prefix not in hierarchy:
+        return None
+    doorstop = import_doorstop()
+    return doorstop.Document(os.path.join(root, hierarchy[prefix]["path"]), root=root)
+
+
+def load_item(root, uid):
+    """
+    Loads a single item file (and the settings of its document) without
+    building the whole tree. Returns None if the item can't be located
+    unambiguously.
+    """
+    location = locate_item(root, uid)
+    if location is None:
+        return None
+    prefix, path = location
+    document = load_document(root, prefix)
+    doorstop = import_doorstop()
+    item = doorstop.Item(document, path, root=root)
+    # Load before making changes, otherwise saving would write defaults
+    item.load()
+    return item
+
+
+def _level_key(value):
+    parts = []
+    for part in str(value).split("."):
+        try:
+            parts.append(int(part))
+        except ValueError:
+            parts.append(0)
+    while len(parts) > 1 and parts[-1] == 0:
+        parts.pop()
+    return tuple(parts)
+
+
+def _read_item_file(path):
+    """
+    Parses an item file into the fields of an ItemRecord (apart from uid,
+    prefix and path), as a JSON serializable list.
+    """
+    with open(path, mode="r", encoding="utf-8") as fh:
+        data = yaml.load(fh, Loader=YamlLoader) or {}
+
+    header = str(data.get("header") or "").strip()
+    text = header if header else str(data.get("text") or "").strip().split("\n")[0]
+    links = []
+    for link in data.get("links") or []:
+        links.extend(link.keys() if isinstance(link, dict) else [link])
+    references = [
+        [
+            str(reference.get("path", "")),
+            str(reference.get("type", "file")),
+            reference.get("keyword"),
+        ]
+        for reference in data.get("references") or []
+        if isinstance(reference, dict)
+    ]
+    return [
+        text,
+        list(_level_key(data.get("level", 1.0))),
+        bool(data.get("active", True)),
+        bool(data.get("normative", True)),
+        bool(data.get("derived", False)),
+        [str(link) for link in links],
+        references,
+    ]
+
+
+class ItemRecord:
+    """
+    Compact, read-only record of an item with only the fields that the
+    plugin needs. Prefixes, uids of links and reference paths are interned,
+    since the same strings occur in many records.
+    """
+
+    __slots__ = (
+        "uid",
+        "prefix",
+        "path",
+        "text",
+        "level",
+        "active",
+        "normative",
+        "derived",
+        "links",
+        "references",
+    )
+
+    def __init__(self, uid, prefix, path, fields):
+        text, level, active, normative, derived, links, references = fields
+        self.uid = uid
+        self.prefix = prefix
+        self.path = path
+        self.text = text
+        self.level = tuple(level)
+        self.active = active
+        self.normative = normative
+        self.derived = derived
+        self.links = tuple(sys.intern(link) for link in links)
+        self.references = tuple(
+            (sys.intern(path), sys.intern(kind), keyword)
+            for path, kind, keyword in references
+        )
+
+    def to_dict(self):
+        return {"uid": self.uid, "path": self.path, "text": self.text}
+
+    def reference_dicts(self):
+        result = []
+        for path, kind, keyword in self.references:
+            reference = {"type": kind, "path": path}
+            if keyword is not None:
+                reference["keyword"] = keyword
+            result.append(reference)
+        return result
+
+
+def _item_files(root, prefix, document):
+    """
+    Yields the paths of the item files of a document, skipping the folders
+    of embedded documents, like doorstop does.
+    """
+    folder = _document_folder(root, document)
+    start = (prefix + document["sep"]).lower()
+    for dirpath, dirnames, filenames in os.walk(folder):
+        dirnames[:] = [
+            dirname
+            for dirname in dirnames
+            if not os.path.isfile(os.path.join(dirpath, dirname, CONFIG))
+        ]
+        for filename in filenames:
+            name, extension = os.path.splitext(filename)
+            if (
+                extension in ITEM_EXTENSIONS
+                and name.lower().startswith(start)
+                and len(name) > len(start)
+            ):
+                yield os.path.join(dirpath, filename)
+
+
+def _git(root, *args):
+    try:
+        return subprocess.check_output(
+            ["git", "-C", root] + list(args), stderr=subprocess.DEVNULL
+        ).decode("utf-8")
+    except (OSError, subprocess.CalledProcessError, UnicodeDecodeError):
+        return None
+
+
+def _git_paths(root, toplevel, output):
+    """
+    Converts NUL separated paths relative to the git toplevel
+    into paths relative to root.
+    """
+    real_root = os.path.realpath(root)
+    return {
+        os.path.relpath(os.path.join(toplevel, os.path.normpath(path)), real_root)
+        for path in output.split("\0")
+        if path
+    }
+
+
+def git_state(root):
+    """
+    Returns the HEAD commit of the git repository that root is in and the
+    files under root that differ from it, or None when git or the
+    repository isn't available.
+    """
+    output = _git(root, "rev-parse", "--show-toplevel", "HEAD")
+    if output is None:
+        return None
+    toplevel, head = output.split("\n")[:2]
+    status = _git(
+        root, "status", "--porcelain", "-z", "--no-renames", "-uall", "--", "."
+    )
+    if status is None:
+        return None
+    # Each entry is "XY path"
+    entries = "\0".join(entry[3:] for entry in status.split("\0") if entry)
+    dirty = sorted(_git_paths(root, toplevel, entries))
+    return {"toplevel": toplevel, "head": head, "dirty": dirty}
+
+
+def git_changed_paths(root, state, cached):
+    """
+    Returns the paths (relative to root) of the files that might have
+    changed since the cached git state was taken: files that changed in
+    the commits in between, and files that were uncommitted then or now.
+    Returns None when that can't be determined.
+    """
+    if cached.get("toplevel") != state["toplevel"]:
+        return None
+    changed = set(state["dirty"]) | set(cached.get("dirty", []))
+    if cached.get("head") != state["head"]:
+        output = _git(
+            root,
+            "diff",
+            "--name-only",
+            "-z",
+            "--no-renames",
+            cached.get("head", ""),
+            state["head"],
+            "--",
+            ".",
+        )
+        if output is None:
+            return None
+        changed |= _git_paths(root, state["toplevel"], output)
+    return changed
+
+
+def _document_of(root, folders, relpath, check=False):
+    """
+    Returns the prefix of the document that the item file at relpath
+    belongs to, or None. The folders map document paths to prefixes. With
+    check, folders of documents that aren't part of the tree end the search.
+    """
+    name, extension = os.path.splitext(os.path.basename(relpath))
+    if extension not in ITEM_EXTENSIONS or relpath.startswith(os.pardir):
+        return None
+    dirname = os.path.dirname(relpath) or os.curdir
+    while dirname not in folders:
+        if dirname == os.curdir:
+            return None
+        if check and os.path.isfile(os.path.join(root, dirname, CONFIG)):
+            return None
+        dirname = os.path.dirname(dirname) or os.curdir
+    return folders[dirname]
+
+
+# root -> (cache, {relpath: (entry, ItemRecord)}) of the last loaded
+# indexes, least recently used first
+_resident = OrderedDict()
+_resident_lock = threading.Lock()
+# Snapshots of a long running process, None for a single command
+snapshots = None
+
+
+class Index:
+    """
+    Compact in-memory index of all items in the tree, used by all read
+    queries instead of the full doorstop objects. The parsed records are
+    cached between runs per file stamp, so only changed item files are
+    parsed again. When no directory changed since the cache was written,
+    only the stamps of the cached files are checked. Otherwise, inside a
+    git repository, only the files that git reports as changed are
+    checked, and all item files elsewhere.
+    """
+
+    def __init__(self, root, documents, records):
+        self.root = root
+        self.documents = documents
+        self.records = records
+        self._by_lower_uid = None
+        self._linked_by = None
+
+    @classmethod
+    def load(cls, root):
+        """
+        Returns the index of the tree at root. In a long running process,
+        this is a snapshot that is never half way a write.
+        """
+        if snapshots is not None:
+            return snapshots.read(root)
+        return cls.build(root)
+
+    @classmethod
+    def build(cls, root):
+        documents, dirs = _document_hierarchy(root)
+        with _resident_lock:
+            resident = _resident.pop(root, None)
+        if resident is not None:
+            # Still in memory, so neither the cache file nor the unchanged
+            # records have to be read again
+            cached, resident_records = resident
+        else:
+            cached, resident_records = load_cache(root, "items.json") or {}, {}
+        if (
+            cached.get("version") != INDEX_VERSION
+            or cached.get("documents") != documents
+        ):
+            cached = {}
+        entries = cached.get("files", {})
+
+        if entries and cached.get("dirs") == dirs:
+            # No file was added to or removed from any directory since the
+            # cache was written, so checking the stamps of the cached files
+            # is enough and git isn't asked
+            git = cached.get("git")
+            files = cls._cached_files(root, cls._folders(documents), entries)
+            trusted = set()
+        else:
+            git = git_state(root)
+            changed_paths = None
+            if entries and git and cached.get("git"):
+                changed_paths = git_changed_paths(root, git, cached["git"])
+            if changed_paths is None:
+                files = cls._walk(root, documents)
+                trusted = set()
+            else:
+                files, trusted = cls._git_files(root, documents, entries, changed_paths)
+
+        found = {}
+        records = {}
+        by_path = {}
+        changed = False
+        for relpath, prefix in files:
+            path = os.path.join(root, relpath)
+            entry = entries.get(relpath)
+            if relpath not in trusted:
+                stamp = file_stamp(path)
+                if stamp is None:
+                    continue
+                if entry is None or entry[0] != stamp:
+                    try:
+                        entry = [stamp, _read_item_file(path)]
+                    except Exception as e:
+                        logger.warning("Could not read {}: {}".format(path, e))
+                        continue
+                    changed = True
+            found[relpath] = entry
+            previous = resident_records.get(relpath)
+            if previous is not None and previous[0] is entry:
+                record = previous[1]
+            else:
+                uid = os.path.splitext(os.path.basename(path))[0]
+                record = ItemRecord(uid, prefix, path, entry[1])
+            records[record.uid] = record
+            by_path[relpath] = (entry, record)
+
+        cache = {
+            "version": INDEX_VERSION,
+            "documents": documents,
+            "git": git,
+            "dirs": dirs,
+            "files": found,
+        }
+        if (
+            changed
+            or len(found) != len(entries)
+            or git != cached.get("git")
+            or dirs != cached.get("dirs")
+        ):
+            save_cache(root, "items.json", cache)
+        with _resident_lock:
+            _resident[root] = (cache, by_path)
+            while len(_resident) > RESIDENT_INDEXES:
+                _resident.popitem(last=False)
+        return cls(root, documents, records)
+
+    @staticmethod
+    def _walk(root, documents):
+        """
+        Returns (relpath, prefix) for all item files in the tree.
+        """
+        files = []
+        for prefix, document in documents.items():
+            prefix = sys.intern(prefix)
+            for path in _item_files(root, prefix, document):
+                files.append((os.path.relpath(path, root), prefix))
+        return files
+
+    @staticmethod
+    def _folders(documents):
+        return {
+            os.path.normpath(document["path"]): sys.intern(prefix)
+            for prefix, document in documents.items()
+        }
+
+    @staticmethod
+    def _cached_files(root, folders, entries):
+        """
+        Returns (relpath, prefix) for the cached item files.
+        """
+        files = []
+        for relpath in entries:
+            prefix = _document_of(root, folders, relpath)
+            if prefix is not None:
+                files.append((relpath, prefix))
+        return files
+
+    @classmethod
+    def _git_files(cls, root, documents, entries, changed_paths):
+        """
+        Returns (relpath, prefix) for the cached item files and for the new
+        item files among the changed paths, and the set of cached files
+        that git reports as unchanged, which don't need to be checked.
+        """
+        folders = cls._folders(documents)
+        files = cls._cached_files(root, folders, entries)
+        for relpath in changed_paths - entries.keys():
+            prefix = _document_of(root, folders, relpath, check=True)
+            if prefix is None:
+                continue
+            start = (prefix + documents[prefix]["sep"]).lower()
+            name = os.path.splitext(os.path.basename(relpath))[0]
+            if name.lower().startswith(start) and len(name) > len(start):
+                files.append((relpath, prefix))
+        return files, set(entries) - changed_paths
+
+    def __iter__(self):
+        return iter(self.records.values())
+
+    def find(self, uid):
+        """
+        Returns the record for the uid (case insensitive, like doorstop),
+        or None when there is no such item.
+        """
+        record = self.records.get(uid)
+        if record is not None:
+            return record
+        if self._by_lower_uid is None:
+            self._by_lower_uid = {
+                key.lower(): value for key, value in self.records.items()
+            }
+        return self._by_lower_uid.get(uid.lower())
+
+    def document_path(self, prefix):
+        return _document_folder(self.root, self.documents[prefix])
+
+    def document_items(self, prefix):
+        """
+        Returns the active items of a document, ordered by level.
+        """
+        return sorted(
+            (record for record in self if record.prefix == prefix and record.active),
+            key=lambda record: (record.level, record.uid),
+        )
+
+    def linked_by(self, uid):
+        """
+        Returns the records of all items that link to the given uid.
+        """
+        if self._linked_by is None:
+            self._linked_by = {}
+            for record in self:
+                for parent in self.parents(record):
+                    self._linked_by.setdefault(parent.uid, []).append(record)
+        return self._linked_by.get(uid, [])
+
+    def parents(self, record):
+        """
+        Returns the records of the items that the record links to (matched
+        case insensitively, like doorstop does).
+        """
+        parents = [self.find(uid) for uid in record.links]
+        return [parent for parent in parents if parent is not None]
+
+    def children(self, record):
+        """
+        Returns the active items in child documents that link to the record.
+        """
+        return [
+            other
+            for other in self.linked_by(record.uid)
+            if other.active
+            and self.documents.get(other.prefix, {}).get("parent") == record.prefix
+        ]
+
+    def linked(self, record):
+        """
+        Returns the active items that link to the record, but
+        are not a child of it.
+        """
+        children = self.children(record)
+        return [
+            other
+            for other in self.linked_by(record.uid)
+            if other.active and other not in children
+        ]
+
+
+def write_index_file(index):
+    """
+    Writes the records of the index in the binary layout of INDEX_FILE and
+    returns its path. The file is replaced atomically, so readers either
+    map the old or the new version.
+    """
+    strings = bytearray()
+    offsets = {}
+
+    def string(value):
+        if value not in offsets:
+            data = value.encode("utf-8")
+            offsets[value] = (len(strings), len(data))
+            strings.extend(data)
+        return offsets[value]
+
+    records = sorted(index, key=lambda record: record.uid.encode("utf-8"))
+    numbers = {}
+    items = bytearray()
+    links = bytearray()
+    link_count = 0
+    by_path = {}
+    for number, record in enumerate(records):
+        numbers[record.uid] = number
+        items += INDEX_ITEM.pack(
+            *string(record.uid),
+            *string(record.path),
+            *string(record.text),
+            link_count,
+            len(record.links),
+        )
+        for link in record.links:
+            links += INDEX_LINK.pack(*string(link))
+        link_count += len(record.links)
+        for path, _, keyword in record.references:
+            by_path.setdefault(path, []).append((number, keyword))
+
+    paths = bytearray()
+    references = bytearray()
+    reference_count = 0
+    for path in sorted(by_path, key=lambda path: path.encode("utf-8")):
+        entries = by_path[path]
+        paths += INDEX_PATH.pack(*string(path), reference_count, len(entries))
+        for number, keyword in entries:
+            if keyword is None:
+                references += INDEX_REFERENCE.pack(number, 0, NO_KEYWORD)
+            else:
+                references += INDEX_REFERENCE.pack(number, *string(keyword))
+        reference_count += len(entries)
+
+    sections = [items, links, paths, references, strings]
+    section_offsets = []
+    offset = INDEX_HEADER.size
+    for section in sections:
+        section_offsets.append(offset)
+        offset += len(section)
+    header = INDEX_HEADER.pack(
+        INDEX_MAGIC,
+        INDEX_FILE_VERSION,
+        len(records),
+        len(by_path),
+        *section_offsets,
+    )
+
+    path = cache_path(index.root, INDEX_FILE)
+    tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    with open(tmp_path, mode="wb") as fh:
+        fh.write(header)
+        for section in sections:
+            fh.write(section)
+    # Fails on Windows while the plugin host still maps the old file,
+    # the caller then keeps using the backend for reads
+    os.replace(tmp_path, path)
+    return path
+
+
+class Snapshots:
+    """
+    Immutable index snapshots for a long running process, in which reads
+    and writes run concurrently. Writes are applied one at a time. While a
+    write of a root is in progress, reads of that root get the last
+    published snapshot instead of waiting for the write or seeing half
+    written files. Each write publishes a new snapshot when it is done.
+    Otherwise reads bring the snapshot up to date with the files, which
+    concurrent reads of a root share.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Notified when a write or a read of files (see read_files) ends
+        self.changed = threading.Condition(self.lock)
+        self.write_lock = threading.Lock()
+        # Incremented for each start and end of a write and each publish
+        self.generation = 0
+        # root -> Index of the last snapshot
+        self.published = {}
+        # root -> number of writes that are in progress
+        self.writing = {}
+        # root -> Event that is set when the snapshot that reads are
+        # building is published
+        self.building = {}
+        # root -> number of read_files calls that are in progress
+        self.reading = {}
+
+    def read(self, root):
+        with self.lock:
+            if self.writing.get(root):
+                return self.published[root]
+            built = self.building.get(root)
+            if built is None:
+                built = self.building[root] = threading.Event()
+                started = self.generation
+            else:
+                started = None
+
+        if started is None:
+            built.wait()
+            with self.lock:
+                index = self.published.get(root)
+            if index is None:
+                # The build of the other read failed
+                return self.read(root)
+            return index
+
+        try:
+            index = Index.build(root)
+            with self.lock:
+                # Only publish when no write started or ended while loading
+                if self.generation == started:
+                    self.generation += 1
+                    self.published[root] = index
+                    return index
+                return self.published.get(root, index)
+        finally:
+            with self.lock:
+                del self.building[root]
+            built.set()
+
+    def write(self, root, func):
+        """
+        Runs func, which writes to the tree at root, after the writes that
+        are queued before it, and publishes a new snapshot afterwards.
+        """
+        with self.write_lock:
+            with self.lock:
+                missing = root not in self.published
+            if missing:
+                # Reads during the write need a snapshot from before it
+                index = Index.build(root)
+                with self.lock:
+                    self.generation += 1
+                    self.published.setdefault(root, index)
+            with self.changed:
+                self.generation += 1
+                self.writing[root] = self.writing.get(root, 0) + 1
+                # Reads of files that started before the write finish first
+                while self.reading.get(root):
+                    self.changed.wait()
+            try:
+                return func()
+            finally:
+                index = None
+                try:
+                    index = Index.build(root)
+                finally:
+                    with self.changed:
+                        self.generation += 1
+                        self.writing[root] -= 1
+                        if index is not None:
+                            self.published[root] = index
+                        self.changed.notify_all()
+
+    def read_files(self, root, read, wait=False):
+        """
+        Runs read, which reads item files of root directly instead of from
+        a snapshot, while no write of root is in progress. When one is,
+        returns None instead, or with wait, runs read after the write.
+        """
+        with self.changed:
+            while self.writing.get(root):
+                if not wait:
+                    return None
+                self.changed.wait()
+            self.reading[root] = self.reading.get(root, 0) + 1
+        try:
+            return read()
+        finally:
+            with self.changed:
+                self.reading[root] -= 1
+                self.changed.notify_all()
+
+
+class PathIndex:
+    """
+    Index of all files under root, to resolve reference paths without
+    globbing the file system for every reference. Paths are resolved like
+    `Path(root).rglob(path)`: the path may match the end of any file path.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.by_name = {}
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [
+                dirname for dirname in dirnames if dirname not in EXCLUDE_DIRNAMES
+            ]
+            relative = os.path.relpath(dirpath, root)
+            for filename in filenames:
+                relpath = filename if relative == "." else relative + "/" + filename
+                self.by_name.setdefault(filename, []).append(relpath)
+
+    def resolve(self, path):
+        """
+        Returns the absolute path of the file that path refers to,
+        or None when it doesn't resolve.
+        """
+        path = path.replace(os.sep, "/").strip("/")
+        if glob.has_magic(path):
+            for match in glob.iglob(
+                os.path.join(self.root, "**", path), recursive=True
+            ):
+                if os.path.isfile(match):
+                    return match
+            return None
+
+        name = path.rsplit("/", 1)[-1]
+        matches = [
+            relpath
+            for relpath in self.by_name.get(name, [])
+            if relpath == path or relpath.endswith("/" + path)
+        ]
+        if not matches:
+            return None
+        return os.path.join(self.root, min(matches, key=len))
+
+
+class KeywordCache:
+    """
+    Thread safe cache of file contents, to look up the location of
+    keywords in referenced files.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.contents = {}
+
+    def content(self, file):
+        with self.lock:
+            if file in self.contents:
+                return self.contents[file]
+        try:
+            with open(file, mode="r", encoding="utf-8") as fh:
+                content = fh.read()
+        except (OSError, UnicodeDecodeError):
+            content = None
+        with self.lock:
+            self.contents[file] = content
+        return content
+
+    def find(self, file, keyword):
+        """
+        Returns (point, row, column) of the first line in file that
+        contains keyword, or None when it can't be found.
+        """
+        content = self.content(file)
+        if content is None or "\n" in keyword:
+            return None
+        point = content.find(keyword)
+        if point == -1:
+            return None
+        line_start = content.rfind("\n", 0, point) + 1
+        return point, content.count("\n", 0, point) + 1, point - line_start + 1
+
+
+class KeywordIndex:
+    """
+    Thread safe index of the keyword locations in referenced files. Per
+    file, the content and line starts are kept together with the locations
+    of all keywords that were asked for, until the file changes on disk.
+    """
+
+    def __init__(self, size=RESIDENT_KEYWORD_FILES):
+        self.lock = threading.Lock()
+        self.size = size
+        # file -> (stamp, content, line starts, {keyword: locations}),
+        # least recently used first
+        self.files = OrderedDict()
+
+    def _entry(self, file):
+        try:
+            stat = os.stat(file)
+        except OSError:
+            return None
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            entry = self.files.get(file)
+            if entry is not None and entry[0] == stamp:
+                self.files.move_to_end(file)
+                return entry
+
+        # Read like the editor does: universal newlines and without a
+        # byte order mark, so that offsets match the positions in a view
+        try:
+            with open(file, mode="r", encoding="utf-8-sig") as fh:
+                content = fh.read()
+        except (OSError, UnicodeDecodeError):
+            content = None
+        line_starts = [0]
+        if content is not None:
+            point = content.find("\n")
+            while point != -1:
+                line_starts.append(point + 1)
+                point = content.find("\n", point + 1)
+        entry = (stamp, content, line_starts, {})
+        with self.lock:
+            self.files[file] = entry
+            self.files.move_to_end(file)
+            while len(self.files) > self.size:
+                self.files.popitem(last=False)
+        return entry
+
+    def locations(self, file, keyword):
+        """
+        Returns a list of {offset, row, column} dicts of all occurrences of
+        keyword in file, or None when the file can't be read. Rows and
+        columns start at 1.
+        """
+        entry = self._entry(file)
+        if entry is None or entry[1] is None:
+            return None
+        _, content, line_starts, by_keyword = entry
+        with self.lock:
+            if keyword in by_keyword:
+                return by_keyword[keyword]
+
+        locations = []
+        offset = content.find(keyword)
+        while offset != -1:
+            row = bisect.bisect_right(line_starts, offset)
+            locations.append(
+                {
+                    "offset": offset,
+                    "row": row,
+                    "column": offset - line_starts[row - 1] + 1,
+                }
+            )
+            offset = content.find(keyword, offset + 1)
+        with self.lock:
+            by_keyword[keyword] = locations
+        return locations
+
+
+# Keyword index of referenced files, kept for the lifetime of the process
+keyword_index = KeywordIndex()
+
+
+def tree_order(documents):
+    """
+    Returns the prefixes of the documents in the order of doorstop's tree:
+    the root document first, and each document followed by its child
+    documents in the order they were found.
+    """
+    by_parent = {}
+    for prefix, document in documents.items():
+        parent = document.get("parent")
+        if parent:
+            parent = parent.lower()
+        by_parent.setdefault(parent, []).append(prefix)
+
+    result = []
+
+    def visit(parent):
+        for prefix in by_parent.get(parent, []):
+            if prefix not in result:
+                result.append(prefix)
+                visit(prefix.lower())
+
+    visit(None)
+    # Documents of which the parent is unknown
+    result.extend(prefix for prefix in documents if prefix not in result)
+    return result
+
+
 def document(args):
-    tree = doorstop.build(root=args.root)
-    prefixes = [{"prefix": doc.prefix, "path": doc.path} for doc in tree.documents]
-    print(json.dumps(prefixes))
+    index = Index.load(args.root)
+    prefixes = [
+        {"prefix": prefix, "path": index.document_path(prefix)}
+        for prefix in tree_order(index.documents)
+    ]
+    print(json.dumps(prefixes), file=args.out)
+
+
+def match_rank(record, terms):
+    """
+    Returns how well the uid and text of the record match all of the (lower
+    case) terms, lower is better. Returns None when a term matches neither.
+    """
+    uid = record.uid.lower()
+    text = record.text.lower()
+    rank = 0
+    for term in terms:
+        if uid == term:
+            rank += 0
+        elif uid.startswith(term):
+            rank += 1
+        elif term in uid:
+            rank += 2
+        elif text.startswith(term) or " " + term in text:
+            rank += 3
+        elif term in text:
+            rank += 4
+        else:
+            return None
+    return rank
 
 
 def items(args):
-    tree = doorstop.build(root=args.root)
-    document = tree.find_document(args.prefix)
-    items = [item_to_dict(item) for item in document.items]
-    print(json.dumps(items))
+    index = Index.load(args.root)
+    records = index.document_items(args.prefix)
+    if args.query:
+        terms = args.query.lower().split()
+        ranked = [
+            (rank, number, record)
+            for number, record in enumerate(records)
+            for rank in [match_rank(record, terms)]
+            if rank is not None
+        ]
+        records = [record for _, _, record in sorted(ranked, key=lambda x: x[:2])]
+    end = None if args.limit is None else args.offset + args.limit
+    items = [record.to_dict() for record in records[args.offset : end]]
+    print(json.dumps(items), file=args.out)
 
 
 def parents(args):
-    tree = doorstop.build(root=args.root)
-    item = tree.find_item(args.item)
-    parents = [item_to_dict(item) for item in item.parent_items]
-    print(json.dumps(parents))
+    index = Index.load(args.root)
+    record = index.find(args.item)
+    parents = []
+    # None for an item that isn't saved yet, which has no links yet
+    if record is not None:
+        parents = [parent.to_dict() for parent in index.parents(record)]
+    print(json.dumps(parents), file=args.out)
 
 
 def children(args):
-    tree = doorstop.build(root=args.root)
-    item = tree.find_item(args.item)
-    children = [item_to_dict(item) for item in item.child_items]
-    print(json.dumps(children))
+    index = Index.load(args.root)
+    record = index.find(args.item)
+    children = []
+    if record is not None:
+        children = [child.to_dict() for child in index.children(record)]
+    print(json.dumps(children), file=args.out)
 
 
 def find_references(args):
-    tree = doorstop.build(root=args.root)
+    index = Index.load(args.root)
     path = args.path
+    file = os.path.join(args.root, path)
     results = []
-    for document in tree:
-        for item in document:
-            if item.references:
-                for reference in item.references:
-                    if reference["path"] == path:
-                        result = item_to_dict(item)
-                        result["keyword"] = reference.get("keyword")
-                        results.append(result)
+    for record in index:
+        for reference_path, _, keyword in record.references:
+            if reference_path == path:
+                result = record.to_dict()
+                result["keyword"] = keyword
+                if args.locations and keyword:
+                    result["locations"] = keyword_index.locations(file, keyword)
+                results.append(result)
+
+    print(json.dumps(results), file=args.out)
+
 
-    print(json.dumps(results))
+def referenced_paths(args):
+    index = Index.load(args.root)
+    results = {}
+    for record in index:
+        paths = {path for path, _, _ in record.references}
+        if paths:
+            results[record.uid] = sorted(paths)
+
+    print(json.dumps(results), file=args.out)
 
 
 def linked(args):
-    tree = doorstop.build(root=args.root)
-    target = tree.find_item(args.item)
+    index = Index.load(args.root)
+    record = index.find(args.item)
+    result = []
+    if record is not None:
+        result = [other.to_dict() for other in index.linked(record)]
+    print(json.dumps(result), file=args.out)
 
-    # Find all items that link to the given item
-    linked = []
-    for document in tree.documents:
-        for item in document.items:
-            if target.uid in item.links and item.uid not in target.child_links:
-                linked.append(item)
 
-    result = [item_to_dict(item) for item in linked]
-    print(json.dumps(result))
+def publish_index(args):
+    index = Index.load(args.root)
+    try:
+        path = write_index_file(index)
+    except OSError as e:
+        logger.warning("Could not write index file: {}".format(e))
+        path = None
+    print(json.dumps({"path": path, "items": len(index.records)}), file=args.out)
+
+
+def link_direction(root, child, parent):
+    """
+    Returns the (source, target) items for linking child to parent. When the
+    child is actually a parent of the parent, the order is reversed.
+    """
+    parents = document_ancestors(root, str(parent.document.prefix))
+    if str(child.document.prefix) in parents:
+        return parent, child
+    return child, parent
 
 
 def link(args):
-    tree = doorstop.build(root=args.root)
-    child = tree.find_item(args.child)
-    parent = tree.find_item(args.parent)
-    doc = parent.document
-    parents = []
-    while doc:
-        parents.append(doc)
-        try:
-            doc = tree.find_document(doc.parent)
-        except Exception:
-            break
-
-    # child is actually a parent of the
-    # parent, so reverse the order
-    if child.document in parents:
-        parent.link(child)
-        print(json.dumps(item_to_dict(parent)))
-    else:
-        child.link(parent)
-        print(json.dumps(item_to_dict(child)))
+    child = load_item(args.root, args.child)
+    parent = load_item(args.root, args.parent)
+    if child is None or parent is None:
+        tree = import_doorstop().build(root=args.root)
+        child = tree.find_item(args.child)
+        parent = tree.find_item(args.parent)
 
+    source, target = link_direction(args.root, child, parent)
+    source.link(target.uid)
+    print(json.dumps(item_to_dict(source)), file=args.out)
 
-def add_reference_to_item(args):
-    tree = doorstop.build(root=args.root)
-    reference = json.loads(args.reference)
-    item = tree.find_item(args.item)
+
+def reference_key(reference):
+    return json.dumps(reference, sort_keys=True)
+
+
+def add_references(item, references, existing=None):
+    """
+    Adds the references that the item doesn't have yet, without saving.
+    Duplicates are detected with a set of the keys of the existing
+    references, which can be passed in to reuse it for multiple calls.
+    Returns the number of added references.
+    """
     if not item.references:
         item.references = []
+    if existing is None:
+        existing = {reference_key(reference) for reference in item.references}
 
-    if reference not in item.references:
+    added = 0
+    for reference in references:
+        key = reference_key(reference)
+        if key in existing:
+            continue
+        existing.add(key)
         item.references.append(reference)
+        added += 1
+    return added
+
+
+def add_reference_to_item(args):
+    references = [json.loads(reference) for reference in args.reference]
+    item = load_item(args.root, args.item)
+    if item is None:
+        tree = import_doorstop().build(root=args.root)
+        item = tree.find_item(args.item)
+
+    item.auto = False
+    if add_references(item, references):
         item.save()
 
-    print(json.dumps(item_to_dict(item)))
+    print(json.dumps(item_to_dict(item)), file=args.out)
+
+
+def _validate_edit(edit):
+    kind = edit.get("type")
+    if kind == "link":
+        if not edit.get("child") or not edit.get("parent"):
+            return "link needs a 'child' and a 'parent'"
+        if _edit_key(edit["child"]) == _edit_key(edit["parent"]):
+            return "can't link {} to itself".format(edit["child"])
+    elif kind == "reference":
+        if not edit.get("item"):
+            return "reference needs an 'item'"
+        reference = edit.get("reference")
+        if not isinstance(reference, dict) or not reference.get("path"):
+            return "reference for {} needs a 'path'".format(edit["item"])
+    else:
+        return "unknown edit type: {}".format(kind)
+    return None
+
+
+def _edit_uids(edit):
+    if edit.get("type") == "link":
+        return [str(edit["child"]), str(edit["parent"])]
+    return [str(edit["item"])]
+
+
+def _edit_key(uid):
+    # Doorstop matches uids ignoring case
+    return str(uid).lower()
+
+
+def apply_edits(root, edits):
+    """
+    Applies a list of link and reference edits as one transaction. Every
+    involved item is loaded once and all edits are validated before anything
+    is written. Changed item files are written together, and restored when
+    one of the writes fails. Returns a summary of the result.
+    """
+    summary = {"changed": [], "unchanged": [], "errors": []}
+    for edit in edits:
+        error = _validate_edit(edit)
+        if error:
+            summary["errors"].append(error)
+    if summary["errors"]:
+        return summary
+
+    uids = {}
+    for edit in edits:
+        for uid in _edit_uids(edit):
+            uids.setdefault(_edit_key(uid), uid)
+    items = {key: load_item(root, uid) for key, uid in uids.items()}
+
+    missing = [key for key, item in items.items() if item is None]
+    if missing:
+        doorstop = import_doorstop()
+        tree = doorstop.build(root=root)
+        for key in missing:
+            try:
+                items[key] = tree.find_item(uids[key])
+            except doorstop.common.DoorstopError:
+                summary["errors"].append("unknown item: {}".format(uids[key]))
+    if summary["errors"]:
+        return summary
+    # One item object per item, however its uid was written in the edits
+    loaded = {}
+    for key, item in items.items():
+        items[key] = loaded.setdefault(str(item.uid), item)
+
+    for item in loaded.values():
+        # Collect all changes in memory, they are saved at the end
+        item.auto = False
+
+    changed = []
+    # Items that the edits apply to, also when they are already up to date
+    edited = []
+    existing_references = {}
+    for edit in edits:
+        if edit["type"] == "link":
+            source, target = link_direction(
+                root, items[_edit_key(edit["child"])], items[_edit_key(edit["parent"])]
+            )
+            edited.append(source)
+            if target.uid in source.links:
+                continue
+            source.link(target.uid)
+        else:
+            source = items[_edit_key(edit["item"])]
+            edited.append(source)
+            if not source.references:
+                source.references = []
+            existing = existing_references.setdefault(
+                str(source.uid),
+                {reference_key(reference) for reference in source.references},
+            )
+            if not add_references(source, [edit["reference"]], existing):
+                continue
+        if source not in changed:
+            changed.append(source)
+
+    originals = {}
+    try:
+        for item in changed:
+            with open(item.path, mode="rb") as fh:
+                originals[item.path] = fh.read()
+        for item in changed:
+            item.save()
+    except Exception as e:
+        for path, content in originals.items():
+            with open(path, mode="wb") as fh:
+                fh.write(content)
+        summary["errors"].append("could not save changes: {}".format(e))
+        return summary
+
+    summary["changed"] = [item_to_dict(item) for item in changed]
+    for item in edited:
+        uid = str(item.uid)
+        if item not in changed and uid not in summary["unchanged"]:
+            summary["unchanged"].append(uid)
+    return summary
+
+
+def batch(args):
+    print(json.dumps(apply_edits(args.root, json.loads(args.edits))), file=args.out)
 
 
 def add_item(args):
-    tree = doorstop.build(root=args.root)
-    document = tree.find_document(args.prefix)
+    document = load_document(args.root, args.prefix)
+    if document is None:
+        tree = import_doorstop().build(root=args.root)
+        document = tree.find_document(args.prefix)
     item = document.add_item()
     if hasattr(args, "text"):
         item.text = args.text
-    print(json.dumps({str(item.uid): item.path}))
+    print(json.dumps({str(item.uid): item.path}), file=args.out)
+
+
+def read_record(root, uid):
+    """
+    Returns the record of a single item, parsing only its own file. Returns
+    None when the uid can't be matched to exactly one item file.
+    """
+    location = locate_item(root, uid)
+    if location is None:
+        return None
+    prefix, path = location
+    try:
+        fields = _read_item_file(path)
+    except Exception as e:
+        logger.warning("Could not read {}: {}".format(path, e))
+        return None
+    return ItemRecord(os.path.splitext(os.path.basename(path))[0], prefix, path, fields)
+
+
+def read_files(root, read, wait=False):
+    """
+    Returns read(), which reads item files of root directly. In a long
+    running process, reads never overlap with writes, see
+    Snapshots.read_files.
+    """
+    if snapshots is None:
+        return read()
+    return snapshots.read_files(root, read, wait)
 
 
 def find_item(args):
-    tree = doorstop.build(root=args.root)
+    record = read_files(args.root, lambda: read_record(args.root, args.uid))
+    if record is None:
+        # Ambiguous or unknown uid, a uid that only matches when ignoring
+        # case, like doorstop does, or a write of the root is in progress
+        record = Index.load(args.root).find(args.uid)
+    if record is None:
+        print("", file=args.out)
+    else:
+        print(json.dumps(record.to_dict()), file=args.out)
+
+
+def item_fingerprint(root, uid, cache):
+    """
+    Returns doorstop's stamp of the item's content, or None when the item
+    can't be located. Fingerprints are cached per stamp of the item file
+    and of its document's settings (which can add reviewed attributes).
+    """
+    location = locate_item(root, uid)
+    if location is None:
+        return None
+    prefix, path = location
+    document = document_hierarchy(root)[prefix]
+    key = [
+        file_stamp(path),
+        file_stamp(os.path.join(_document_folder(root, document), CONFIG)),
+    ]
+    relpath = os.path.relpath(path, root)
+    entry = cache.get(relpath)
+    if entry is not None and entry[0] == key:
+        return entry[1]
+
+    item = load_item(root, uid)
+    if item is None:
+        return None
+    fingerprint = item.stamp().value
+    cache[relpath] = [key, fingerprint]
+    return fingerprint
+
+
+def link_status(args):
+    """
+    Prints for each link of the item whether it is suspect: the stamp that
+    is stored with the link doesn't match the linked item anymore. Links
+    that are stamped as confirmed or not stamped yet are clear, like
+    `doorstop` treats them.
+    """
+    # The stamps are only in the item files, so a write in progress has
+    # to finish before they can be read
+    result = read_files(
+        args.root, lambda: _link_statuses(args.root, args.item), wait=True
+    )
+    print(json.dumps(result), file=args.out)
+
+
+def _link_statuses(root, uid):
+    location = locate_item(root, uid)
+    if location is None:
+        return []
+    with open(location[1], mode="r", encoding="utf-8") as fh:
+        data = yaml.load(fh, Loader=YamlLoader) or {}
+
+    cache = load_cache(root, "fingerprints.json") or {}
+    original = dict(cache)
+    result = []
+    for link in data.get("links") or []:
+        if isinstance(link, dict):
+            uid, stamp = next(iter(link.items()))
+        else:
+            uid, stamp = link, None
+        uid = str(uid)
+        fingerprint = item_fingerprint(root, uid, cache)
+        if fingerprint is None:
+            status = "unknown"
+        elif not stamp or stamp is True or str(stamp) == fingerprint:
+            status = "clear"
+        else:
+            status = "suspect"
+        result.append({"uid": uid, "status": status})
+
+    if cache != original:
+        save_cache(root, "fingerprints.json", cache)
+    return result
+
+
+def link_graph(index):
+    """
+    Returns dicts of uid -> uids of linked (parent) items and
+    uid -> uids of items that link to it, for all items in the index.
+    Links are resolved like Index.find does, links to unknown items are
+    kept as they are.
+    """
+    parents = {}
+    children = {}
+    for record in index:
+        parents[record.uid] = []
+        for link in record.links:
+            parent = index.find(link)
+            if parent is not None:
+                link = parent.uid
+            parents[record.uid].append(link)
+            children.setdefault(link, []).append(record.uid)
+    return parents, children
+
+
+def _breadth_first(start, edges, depth):
+    """
+    Returns the uids that are reachable from start through edges, up to the
+    given depth (unlimited when depth is None), as a list of
+    (uid, depth, via) in tree order: each uid is followed by the uids
+    that were first reached through it.
+    """
+    reached = {start: (0, None)}
+    queue = deque([start])
+    while queue:
+        uid = queue.popleft()
+        level = reached[uid][0]
+        if depth is not None and level >= depth:
+            continue
+        for other in edges.get(uid, []):
+            if other not in reached:
+                reached[other] = (level + 1, uid)
+                queue.append(other)
+
+    below = {}
+    for uid, (level, via) in reached.items():
+        if via is not None:
+            below.setdefault(via, []).append(uid)
+
+    result = []
+    stack = list(reversed(sorted(below.get(start, []))))
+    while stack:
+        uid = stack.pop()
+        result.append((uid, reached[uid][0], reached[uid][1]))
+        stack.extend(reversed(sorted(below.get(uid, []))))
+    return result
+
+
+def trace(args):
+    """
+    Prints the ancestors and descendants of an item up to the given depth,
+    and all references of the item and its descendants.
+    """
+    index = Index.load(args.root)
+    parents, children = link_graph(index)
+    record = index.find(args.item)
+    if record is None:
+        print("", file=args.out)
+        return
+    target = record.uid
+    depth = args.depth if args.depth and args.depth > 0 else None
+
+    def nodes(edges):
+        result = []
+        for uid, level, via in _breadth_first(target, edges, depth):
+            node = (
+                index.records[uid].to_dict() if uid in index.records else {"uid": uid}
+            )
+            node["depth"] = level
+            node["via"] = via
+            result.append(node)
+        return result
+
+    ancestors = nodes(parents)
+    descendants = nodes(children)
+
+    references = []
+    for uid in [target] + [node["uid"] for node in descendants]:
+        other = index.records.get(uid)
+        if other is None:
+            continue
+        for reference in other.reference_dicts():
+            result = other.to_dict()
+            result["reference"] = reference
+            references.append(result)
+
+    print(
+        json.dumps(
+            {
+                "item": record.to_dict(),
+                "ancestors": ancestors,
+                "descendants": descendants,
+                "references": references,
+            }
+        ),
+        file=args.out,
+    )
+
+
+MATRIX_COLUMNS = ["uid", "text", "child", "child_text", "path", "keyword"]
+
+
+def matrix_rows(index, prefix=None):
+    """
+    Yields the rows of the traceability matrix: one row for each reference
+    of each child item of each item. Items without children and children
+    without references get a row with empty fields.
+    """
+    _, children = link_graph(index)
+
+    for record in index:
+        if prefix and record.prefix != prefix:
+            continue
+        row = {"uid": record.uid, "text": record.text}
+        child_uids = sorted(uid for uid in children.get(record.uid, []))
+        if not child_uids:
+            yield dict(row, child="", child_text="", path="", keyword="")
+        for child_uid in child_uids:
+            child = index.records[child_uid]
+            child_row = dict(row, child=child_uid, child_text=child.text)
+            if not child.references:
+                yield dict(child_row, path="", keyword="")
+            for path, _, keyword in child.references:
+                yield dict(child_row, path=path, keyword=keyword or "")
+
+
+def matrix(args):
+    """
+    Streams the traceability matrix as CSV or JSON lines, to stdout or to
+    the output file. Prints a summary when writing to a file.
+    """
+    index = Index.load(args.root)
+    fh = (
+        open(args.output, mode="w", encoding="utf-8", newline="")
+        if args.output
+        else args.out
+    )
     try:
-        item = tree.find_item(args.uid)
-        print(json.dumps(item_to_dict(item)))
-    except doorstop.common.DoorstopError:
-        print("")
+        if args.format == "csv":
+            writer = csv.DictWriter(fh, fieldnames=MATRIX_COLUMNS)
+            writer.writeheader()
+            write = writer.writerow
+        else:
 
+            def write(row):
+                fh.write(json.dumps(row) + "\n")
 
-if __name__ == "__main__":
+        count = 0
+        for row in matrix_rows(index, args.prefix):
+            write(row)
+            count += 1
+    finally:
+        if args.output:
+            fh.close()
+
+    if args.output:
+        print(json.dumps({"path": args.output, "rows": count}), file=args.out)
+
+
+def _reference_row(item_path, path):
+    """
+    Returns the row in the item file on which the reference path is listed.
+    """
+    try:
+        with open(item_path, mode="r", encoding="utf-8") as fh:
+            for row, line in enumerate(fh, start=1):
+                if path in line:
+                    return row
+    except OSError:
+        pass
+    return 1
+
+
+def _check_references(keywords, file, references):
+    """
+    Checks the given (item, reference) pairs that all refer to the same
+    file path. Returns a list of problems.
+    """
+    problems = []
+    for item, reference in references:
+        message = None
+        if file is None:
+            message = "path does not resolve"
+        elif reference.get("keyword"):
+            if keywords.find(file, reference["keyword"]) is None:
+                message = "keyword not found"
+        if message:
+            result = item.to_dict()
+            result["reference"] = reference
+            result["message"] = message
+            result["row"] = _reference_row(item.path, reference["path"])
+            problems.append(result)
+    return problems
+
+
+def validate_references(args):
+    """
+    Checks all references of all items in the tree and streams a JSON line
+    for every invalid reference, followed by a summary line.
+    """
+    by_path = {}
+    checked = 0
+    for record in Index.load(args.root):
+        for reference in record.reference_dicts():
+            by_path.setdefault(reference["path"], []).append((record, reference))
+            checked += 1
+
+    paths = PathIndex(args.root)
+    keywords = KeywordCache()
+    invalid = 0
+    with ThreadPoolExecutor() as executor:
+        futures = [
+            executor.submit(
+                _check_references,
+                keywords,
+                paths.resolve(path) if path else None,
+                references,
+            )
+            for path, references in by_path.items()
+        ]
+        for future in as_completed(futures):
+            for problem in future.result():
+                invalid += 1
+                print(json.dumps(problem), file=args.out)
+            args.out.flush()
+
+    print(
+        json.dumps({"summary": {"checked": checked, "invalid": invalid}}), file=args.out
+    )
+
+
+# Gaps that the coverage command reports
+COVERAGE_GAPS = (
+    "without_parents",
+    "without_children",
+    "without_references",
+    "unresolved_references",
+    "missing_links",
+)
+
+
+def coverage(args):
+    """
+    Reports the gaps in the traceability of the whole tree in one pass,
+    grouped by document: normative items without parents (in documents
+    with a parent document, unless they are derived) or without children
+    (in documents with child documents), normative items without
+    references, references of which the path doesn't resolve and links to
+    items that don't exist.
+    """
+    index = Index.load(args.root)
+    paths = PathIndex(args.root)
+    resolved = {}
+    with_children = {document.get("parent") for document in index.documents.values()}
+
+    documents = {}
+    for prefix in sorted(index.documents):
+        documents[prefix] = {"items": 0, "counts": {}}
+        for gap in COVERAGE_GAPS:
+            documents[prefix][gap] = []
+
+    for record in index:
+        if not record.active or record.prefix not in documents:
+            continue
+        document = documents[record.prefix]
+        document["items"] += 1
+
+        for link in record.links:
+            if index.find(link) is None:
+                result = record.to_dict()
+                result["link"] = link
+                result["row"] = _reference_row(record.path, link)
+                document["missing_links"].append(result)
+
+        for path, _, _ in record.references:
+            if path not in resolved:
+                resolved[path] = paths.resolve(path) if path else None
+            if resolved[path] is None:
+                result = record.to_dict()
+                result["reference"] = path
+                result["row"] = _reference_row(record.path, path)
+                document["unresolved_references"].append(result)
+
+        if not record.normative:
+            continue
+        # Derived items don't need a parent, like doorstop validates
+        has_parent = index.documents[record.prefix].get("parent")
+        if has_parent and not record.derived and not index.parents(record):
+            document["without_parents"].append(record.to_dict())
+        if record.prefix in with_children and not index.children(record):
+            document["without_children"].append(record.to_dict())
+        if not record.references:
+            document["without_references"].append(record.to_dict())
+
+    total = {gap: 0 for gap in COVERAGE_GAPS}
+    for document in documents.values():
+        for gap in COVERAGE_GAPS:
+            document[gap].sort(key=lambda result: result["uid"])
+            document["counts"][gap] = len(document[gap])
+            total[gap] += len(document[gap])
+    total["items"] = sum(document["items"] for document in documents.values())
+
+    print(json.dumps({"documents": documents, "total": total}), file=args.out)
+
+
+def build_parser():
     parser = argparse.ArgumentParser(description="Get information from doorstop")
     parser.add_argument(
         "--root",
@@ -161,6 +1903,22 @@ if __name__ == "__main__":
         type=str,
         help="Prefix of doorstop document",
     )
+    items_command.add_argument(
+        "--query",
+        action="store",
+        type=str,
+        help="Only items of which the uid or text match all words, best first",
+    )
+    items_command.add_argument(
+        "--limit", action="store", type=int, help="Maximum number of items"
+    )
+    items_command.add_argument(
+        "--offset",
+        action="store",
+        type=int,
+        default=0,
+        help="Number of (matching) items to skip",
+    )
 
     add_reference_command = commands.add_parser(
         "add_reference", help="Add reference to specific item"
@@ -176,8 +1934,9 @@ if __name__ == "__main__":
     add_reference_command.add_argument(
         "reference",
         action="store",
+        nargs="+",
         type=str,
-        help="JSON representation of reference to add",
+        help="JSON representation of reference(s) to add",
     )
 
     add_item_command = commands.add_parser("add_item", help="Add item to document")
@@ -193,6 +1952,19 @@ if __name__ == "__main__":
         "--text", action="store", type=str, help="Initial text for new doorstop item"
     )
 
+    batch_command = commands.add_parser(
+        "batch", help="Apply a list of link and reference edits in one transaction"
+    )
+    batch_command.set_defaults(func=batch)
+    batch_command.add_argument(
+        "edits",
+        action="store",
+        type=str,
+        help='JSON list of edits, like {"type": "link", "child": ..., '
+        '"parent": ...} or {"type": "reference", "item": ..., '
+        '"reference": {...}}',
+    )
+
     parents_command = commands.add_parser("parents", help="Get parents for item")
     parents_command.set_defaults(func=parents)
     parents_command.add_argument(
@@ -211,6 +1983,14 @@ if __name__ == "__main__":
         "--item", action="store", required=True, type=str, help="Doorstop item name"
     )
 
+    link_status_command = commands.add_parser(
+        "link_status", help="Get whether the links of an item are suspect"
+    )
+    link_status_command.set_defaults(func=link_status)
+    link_status_command.add_argument(
+        "--item", action="store", required=True, type=str, help="Doorstop item name"
+    )
+
     link_items_command = commands.add_parser("link", help="Link a child to a parent")
     link_items_command.set_defaults(func=link)
     link_items_command.add_argument(
@@ -228,6 +2008,79 @@ if __name__ == "__main__":
     find_references_command.add_argument(
         "path", action="store", type=str, help="path of file"
     )
+    find_references_command.add_argument(
+        "--locations",
+        action="store_true",
+        help="include the locations of the keywords in the file",
+    )
+
+    trace_command = commands.add_parser(
+        "trace",
+        help="Get ancestors, descendants and reachable references of an item",
+    )
+    trace_command.set_defaults(func=trace)
+    trace_command.add_argument(
+        "--item", action="store", required=True, type=str, help="Doorstop item name"
+    )
+    trace_command.add_argument(
+        "--depth",
+        action="store",
+        type=int,
+        default=0,
+        help="Maximum number of links to follow (0 for unlimited)",
+    )
+
+    matrix_command = commands.add_parser(
+        "matrix",
+        help="Stream the traceability matrix: item -> child items -> references",
+    )
+    matrix_command.set_defaults(func=matrix)
+    matrix_command.add_argument(
+        "--format", action="store", choices=["csv", "jsonl"], default="csv"
+    )
+    matrix_command.add_argument(
+        "--prefix",
+        action="store",
+        type=str,
+        help="Only export the items of this document",
+    )
+    matrix_command.add_argument(
+        "--output",
+        action="store",
+        type=str,
+        help="File to write to instead of stdout",
+    )
+
+    referenced_paths_command = commands.add_parser(
+        "referenced_paths",
+        help="Get the referenced paths of all items that have references",
+    )
+    referenced_paths_command.set_defaults(func=referenced_paths)
+
+    publish_index_command = commands.add_parser(
+        "publish_index",
+        help="Write the binary index file that the plugin reads directly",
+    )
+    publish_index_command.set_defaults(func=publish_index)
+
+    validate_references_command = commands.add_parser(
+        "validate_references",
+        help="Check all references of all items (streams JSON lines)",
+    )
+    validate_references_command.set_defaults(func=validate_references)
+
+    coverage_command = commands.add_parser(
+        "coverage",
+        help="Report items without parents, children or references, "
+        "unresolved references and links to missing items, per document",
+    )
+    coverage_command.set_defaults(func=coverage)
+
+    serve_command = commands.add_parser(
+        "serve",
+        help="Answer JSON line requests from stdin, keeping the tree loaded",
+    )
+    serve_command.set_defaults(func=serve)
 
     find_item_command = commands.add_parser(
         "item",
@@ -236,6 +2089,106 @@ if __name__ == "__main__":
     find_item_command.set_defaults(func=find_item)
     find_item_command.add_argument("uid", action="store", type=str, help="uid of item")
 
-    args = parser.parse_args()
-    if hasattr(args, "func"):
+    return parser
+
+
+# Commands that write to the tree
+WRITE_COMMANDS = (add_reference_to_item, link, batch, add_item)
+
+
+def resident_memory():
+    """
+    Returns the resident memory of this process in MB (the peak, on
+    platforms other than Linux), or None when it is unknown.
+    """
+    try:
+        with open("/proc/self/statm", mode="r") as fh:
+            pages = int(fh.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, others kilobytes
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def serve(args):
+    """
+    Answers requests from stdin until it is closed, keeping the index of
+    the root loaded in between. Each request is a JSON line like
+    {"id": 1, "args": ["--root", root, "item", "REQ001"]}, answered by a
+    JSON line with the id, the output of the command, an error message
+    (or null) and the resident memory of the process. Reads are answered
+    concurrently from snapshots, writes one at a time in order, so answers
+    can come out of order.
+    """
+    global snapshots
+    snapshots = Snapshots()
+    output_lock = threading.Lock()
+
+    def answer(request, command):
+        out = io.StringIO()
+        error = None
+        if command is None:
+            error = "invalid arguments: {}".format(request["args"])
+        else:
+            try:
+                run(command, out)
+            except (Exception, SystemExit) as e:
+                error = str(e) or type(e).__name__
+        response = {
+            "id": request["id"],
+            "output": out.getvalue(),
+            "error": error,
+            "rss": resident_memory(),
+        }
+        with output_lock:
+            args.out.write(json.dumps(response) + "\n")
+            args.out.flush()
+
+    parser = build_parser()
+    with ThreadPoolExecutor(max_workers=4) as readers, ThreadPoolExecutor(
+        max_workers=1
+    ) as writer:
+        for line in sys.stdin:
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            try:
+                command = parser.parse_args(request["args"])
+            except SystemExit:
+                command = None
+            if getattr(command, "func", None) in WRITE_COMMANDS:
+                writer.submit(answer, request, command)
+            else:
+                readers.submit(answer, request, command)
+
+
+def main(argv=None, out=None):
+    """
+    Runs the command in argv (defaults to the command line arguments) and
+    writes its output to out (defaults to stdout). Used by the plugin to
+    run commands in process as well.
+    """
+    run(build_parser().parse_args(argv), out)
+
+
+def run(args, out=None):
+    """
+    Runs the command of arguments that main or serve already parsed.
+    """
+    args.out = out or sys.stdout
+    if not hasattr(args, "func"):
+        return
+    if snapshots is not None and args.func in WRITE_COMMANDS:
+        snapshots.write(args.root, lambda: args.func(args))
+    else:
         args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,803 @@
+#!/usr/bin/env python
+"""
+Replays traces of editor events against the listeners of the plugin, with
+stub `sublime` and `sublime_plugin` modules, and reports the latency of the
+event handlers and the number of backend calls. Unlike benchmark.py, which
+times single queries, this shows what bursts of events cost: typing in a
+`references:` block, switching tabs quickly, or sweeping the mouse over a
+view.
+
+    python replay.py --root /path/to/project --scenario all
+    python replay.py --root /path/to/project --scenario typing --save trace.json
+    python replay.py --root /path/to/project --trace trace.json --backend worker
+
+A trace is a JSON list of events, ordered by time. Each event has the time in
+milliseconds since the start (`at`), the kind of `event` and the name of the
+`view` it happens in:
+
+    {"at": 0, "event": "open", "view": "item", "file": "docs/REQ001.yml"}
+    {"at": 50, "event": "activate", "view": "item"}
+    {"at": 80, "event": "modify", "view": "item", "point": 120, "text": "-"}
+    {"at": 90, "event": "hover", "view": "item", "point": 130}
+    {"at": 95, "event": "scroll", "view": "item", "point": 4000}
+    {"at": 99, "event": "save", "view": "item"}
+    {"at": 99, "event": "close", "view": "item"}
+
+Files are relative to the root. Events are dispatched like Sublime Text does:
+the `_async` handlers run one after the other in an async thread, the others
+in a main thread. The latency of a handler is the time from the event until
+the handler finished, so it includes the time it waited for earlier handlers.
+"""
+
+import argparse
+import heapq
+import importlib
+import itertools
+import json
+import os
+import re
+import statistics
+import sys
+import threading
+import time
+import types
+from collections import Counter, defaultdict
+from queue import Queue
+
+import doorstop_cli
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Name under which the plugin is imported, like Sublime Text does
+PACKAGE = "Doorstop"
+LISTENERS = (
+    "DoorstopReferencesListener",
+    "DoorstopLinksListener",
+    "DoorstopReferencedLocationsListener",
+)
+# Sublime Text events, and the handlers that they call in order
+HANDLERS = {
+    "open": ("on_load", "on_load_async"),
+    "activate": ("on_activated", "on_activated_async"),
+    "deactivate": ("on_deactivated", "on_deactivated_async"),
+    "modify": ("on_modified", "on_modified_async"),
+    "hover": ("on_hover",),
+    "save": ("on_post_save", "on_post_save_async"),
+    "close": ("on_close",),
+}
+# Flag of View.find for a literal pattern
+LITERAL = 1
+# Characters in the visible region of a view
+VISIBLE_SIZE = 4000
+# Seconds to wait for the handlers after the last event
+SETTLE_TIMEOUT = 30
+
+
+class Region:
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def size(self):
+        return self.end() - self.begin()
+
+    def empty(self):
+        return self.a == self.b
+
+    def contains(self, x):
+        if isinstance(x, Region):
+            return self.begin() <= x.begin() and x.end() <= self.end()
+        return self.begin() <= x <= self.end()
+
+    def intersects(self, other):
+        return self.begin() < other.end() and other.begin() < self.end()
+
+    def __eq__(self, other):
+        return isinstance(other, Region) and (self.a, self.b) == (other.a, other.b)
+
+    def __hash__(self):
+        return hash((self.a, self.b))
+
+    def __repr__(self):
+        return "({}, {})".format(self.a, self.b)
+
+
+class Settings:
+    def __init__(self, values=None):
+        self.values = dict(values or {})
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def set(self, key, value):
+        self.values[key] = value
+
+    def has(self, key):
+        return key in self.values
+
+    def add_on_change(self, tag, callback):
+        pass
+
+    def clear_on_change(self, tag):
+        pass
+
+
+class Html:
+    def __init__(self, text):
+        self.text = text
+
+
+def _compile(pattern):
+    # Sublime Text accepts a quantifier after the inline flags,
+    # Python doesn't
+    pattern = re.sub(r"^\(\?(\w+)\)\*", r"(?\1)", pattern)
+    return re.compile(pattern, re.MULTILINE)
+
+
+class Buffer:
+    def __init__(self, buffer_id):
+        self.buffer_id = buffer_id
+        self.buffer_views = []
+
+    def id(self):
+        return self.buffer_id
+
+    def views(self):
+        return list(self.buffer_views)
+
+
+class View:
+    """
+    The part of the view API that the plugin uses, on a text in memory.
+    """
+
+    ids = 0
+
+    def __init__(self, window, file_name, text):
+        View.ids += 1
+        self.view_id = View.ids
+        self.view_window = window
+        self.path = file_name
+        self.text = text
+        self.changes = 0
+        self.dirty = False
+        self.valid = True
+        self.scrolled = 0
+        self.regions = {}
+        self.popups = 0
+        self.view_buffer = Buffer(self.view_id)
+        self.view_buffer.buffer_views.append(self)
+        syntax = "Packages/Text/Plain text.tmLanguage"
+        if file_name.endswith((".yml", ".yaml")):
+            syntax = "Packages/YAML/YAML.sublime-syntax"
+        self.view_settings = Settings({"syntax": syntax})
+
+    def id(self):
+        return self.view_id
+
+    def buffer_id(self):
+        return self.view_buffer.id()
+
+    def buffer(self):
+        return self.view_buffer
+
+    def window(self):
+        return self.view_window
+
+    def file_name(self):
+        return self.path
+
+    def settings(self):
+        return self.view_settings
+
+    def is_valid(self):
+        return self.valid
+
+    def is_dirty(self):
+        return self.dirty
+
+    def is_loading(self):
+        return False
+
+    def change_count(self):
+        return self.changes
+
+    def size(self):
+        return len(self.text)
+
+    def substr(self, x):
+        if isinstance(x, Region):
+            return self.text[x.begin() : x.end()]
+        return self.text[x : x + 1]
+
+    def line(self, x):
+        point = x.begin() if isinstance(x, Region) else x
+        begin = self.text.rfind("\n", 0, point) + 1
+        end = self.text.find("\n", point)
+        return Region(begin, len(self.text) if end == -1 else end)
+
+    def find(self, pattern, start_point, flags=0):
+        if flags & LITERAL:
+            pattern = re.escape(pattern)
+        match = _compile(pattern).search(self.text, start_point)
+        if match is None:
+            return Region(-1, -1)
+        return Region(*match.span())
+
+    def find_all(self, pattern, flags=0, fmt=None, extractions=None):
+        return [
+            Region(*match.span()) for match in _compile(pattern).finditer(self.text)
+        ]
+
+    def sel(self):
+        return [Region(self.scrolled)]
+
+    def visible_region(self):
+        return Region(self.scrolled, min(self.size(), self.scrolled + VISIBLE_SIZE))
+
+    def add_regions(self, key, regions, scope="", icon="", flags=0, *args, **kwargs):
+        self.regions[key] = list(regions)
+
+    def get_regions(self, key):
+        return list(self.regions.get(key, []))
+
+    def erase_regions(self, key):
+        self.regions.pop(key, None)
+
+    def show_popup(self, content, flags=0, location=-1, *args, **kwargs):
+        self.popups += 1
+
+    def insert(self, point, text):
+        self.text = self.text[:point] + text + self.text[point:]
+        self.changes += 1
+        self.dirty = True
+
+
+class Window:
+    def __init__(self, root):
+        self.root = root
+        self.window_views = []
+        self.active = None
+
+    def id(self):
+        return 1
+
+    def folders(self):
+        return [self.root]
+
+    def views(self):
+        return list(self.window_views)
+
+    def active_view(self):
+        return self.active
+
+    def project_data(self):
+        return None
+
+    def extract_variables(self):
+        return {"folder": self.root}
+
+    def status_message(self, message):
+        pass
+
+    def open_file(self, *args, **kwargs):
+        pass
+
+    def run_command(self, *args, **kwargs):
+        pass
+
+    def show_quick_panel(self, *args, **kwargs):
+        pass
+
+    def show_input_panel(self, *args, **kwargs):
+        pass
+
+    def create_output_panel(self, *args, **kwargs):
+        return None
+
+
+class EventLoop:
+    """
+    Runs the handlers of the main thread and of the async thread of
+    Sublime Text, and the callbacks of set_timeout(_async).
+    """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.lock = threading.Lock()
+        self.threads = {}
+        self.queues = {}
+        self.timers = []
+        self.order = itertools.count()
+        self.timers_changed = threading.Condition()
+        self.running = True
+        for name in ("main", "async"):
+            self.queues[name] = Queue()
+            self.threads[name] = threading.Thread(
+                target=self._run, args=(self.queues[name],), daemon=True
+            )
+            self.threads[name].start()
+        self.timer_thread = threading.Thread(target=self._run_timers, daemon=True)
+        self.timer_thread.start()
+
+    def post(self, thread, name, func, *args, due=None):
+        """
+        Runs func in the given thread, and records its latency under name
+        when name is given.
+        """
+        self.queues[thread].put((name, due or time.perf_counter(), func, args))
+
+    def _run(self, queue):
+        while True:
+            task = queue.get()
+            if task is None:
+                queue.task_done()
+                return
+            name, due, func, args = task
+            try:
+                func(*args)
+            except Exception as e:
+                print("{} raised {!r}".format(name or func, e))
+            if name:
+                with self.lock:
+                    self.latencies[name].append(time.perf_counter() - due)
+            queue.task_done()
+
+    def set_timeout(self, thread, func, delay):
+        with self.timers_changed:
+            heapq.heappush(
+                self.timers,
+                (time.perf_counter() + delay / 1000, next(self.order), thread, func),
+            )
+            self.timers_changed.notify()
+
+    def _run_timers(self):
+        with self.timers_changed:
+            while self.running:
+                if not self.timers:
+                    self.timers_changed.wait()
+                    continue
+                due, _, thread, func = self.timers[0]
+                wait = due - time.perf_counter()
+                if wait > 0:
+                    self.timers_changed.wait(wait)
+                    continue
+                heapq.heappop(self.timers)
+                self.post(thread, None, func)
+
+    def settle(self, timeout=SETTLE_TIMEOUT):
+        """
+        Waits until the queued handlers ran, or timeout seconds passed.
+        """
+        end = time.perf_counter() + timeout
+        for queue in self.queues.values():
+            while queue.unfinished_tasks and time.perf_counter() < end:
+                time.sleep(0.01)
+
+    def stop(self):
+        with self.timers_changed:
+            self.running = False
+            self.timers_changed.notify()
+        for queue in self.queues.values():
+            queue.put(None)
+
+
+def install_stubs(loop, window_list, listeners):
+    """
+    Installs the stub `sublime` and `sublime_plugin` modules.
+    """
+    sublime = types.ModuleType("sublime")
+    sublime.Region = Region
+    sublime.Settings = Settings
+    sublime.Html = Html
+    sublime.HOVER_TEXT = 1
+    sublime.LITERAL = LITERAL
+    sublime.DRAW_NO_FILL = 32
+    sublime.DRAW_NO_OUTLINE = 256
+    sublime.DRAW_SOLID_UNDERLINE = 512
+    sublime.DRAW_STIPPLED_UNDERLINE = 1024
+    sublime.DRAW_SQUIGGLY_UNDERLINE = 2048
+    sublime.HIDE_ON_MOUSE_MOVE = 2
+    sublime.HIDE_ON_MOUSE_MOVE_AWAY = 4
+    sublime.ENCODED_POSITION = 1
+    sublime.TRANSIENT = 4
+    sublime.MONOSPACE_FONT = 1
+    sublime.settings = Settings()
+    sublime.load_settings = lambda name: sublime.settings
+    sublime.save_settings = lambda name: None
+    sublime.windows = lambda: list(window_list)
+    sublime.active_window = lambda: window_list[0]
+    sublime.error_message = lambda message: print("error: {}".format(message))
+    sublime.status_message = lambda message: None
+    sublime.set_timeout = lambda func, delay=0: loop.set_timeout("main", func, delay)
+    sublime.set_timeout_async = lambda func, delay=0: loop.set_timeout(
+        "async", func, delay
+    )
+    sublime.version = lambda: "4126"
+
+    sublime_plugin = types.ModuleType("sublime_plugin")
+
+    class ViewEventListener:
+        def __init__(self, view):
+            self.view = view
+
+        @classmethod
+        def is_applicable(cls, settings):
+            return True
+
+    class Command:
+        pass
+
+    sublime_plugin.ViewEventListener = ViewEventListener
+    sublime_plugin.EventListener = type("EventListener", (), {})
+    sublime_plugin.ApplicationCommand = type("ApplicationCommand", (Command,), {})
+    sublime_plugin.WindowCommand = type("WindowCommand", (Command,), {})
+    sublime_plugin.TextCommand = type("TextCommand", (Command,), {})
+    sublime_plugin.ListInputHandler = type("ListInputHandler", (), {})
+    sublime_plugin.TextInputHandler = type("TextInputHandler", (), {})
+    sublime_plugin.find_view_event_listener = lambda view, cls: next(
+        (
+            listener
+            for listener in listeners.get(view.id(), [])
+            if isinstance(listener, cls)
+        ),
+        None,
+    )
+
+    sys.modules["sublime"] = sublime
+    sys.modules["sublime_plugin"] = sublime_plugin
+    return sublime
+
+
+def load_plugin():
+    """
+    Imports the plugin as a package, like Sublime Text does.
+    """
+    package = types.ModuleType(PACKAGE)
+    package.__path__ = [PLUGIN_DIR]
+    sys.modules[PACKAGE] = package
+    return importlib.import_module(PACKAGE + ".doorstop_plugin")
+
+
+def default_settings():
+    """
+    Returns the settings of the plugin's settings file.
+    """
+    with open(os.path.join(PLUGIN_DIR, "doorstop.sublime-settings")) as fh:
+        lines = [line for line in fh if not line.strip().startswith("//")]
+    return json.loads("".join(lines))
+
+
+class BackendCalls:
+    """
+    Counts the backend calls of the plugin per command, and the
+    queries that the mapped index file answered.
+    """
+
+    def __init__(self, util):
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        self.wrap(util, "_run_doorstop_command", lambda args, *_: args[2])
+        self.wrap(util, "_stream_doorstop_command", lambda args, *_: args[2])
+        index_query = util._from_index_file
+
+        def from_index_file(root, cmd, args):
+            result = index_query(root, cmd, args)
+            if result is not None:
+                self.count("{} (index file)".format(cmd))
+            return result
+
+        util._from_index_file = from_index_file
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def wrap(self, util, name, command):
+        func = getattr(util, name)
+
+        def wrapper(args, *rest, **kwargs):
+            self.count(command(args))
+            return func(args, *rest, **kwargs)
+
+        setattr(util, name, wrapper)
+
+
+class Replay:
+    def __init__(self, root, settings):
+        self.root = root
+        self.loop = EventLoop()
+        self.window = Window(root)
+        self.listeners = {}
+        self.views = {}
+        self.sublime = install_stubs(self.loop, [self.window], self.listeners)
+        self.sublime.settings.values.update(settings)
+        self.plugin = load_plugin()
+        self.plugin.plugin_loaded()
+        self.calls = BackendCalls(self.plugin.doorstop_util)
+
+    def dispatch(self, view, event, *args, due=None):
+        for handler in HANDLERS[event]:
+            thread = "async" if handler.endswith("_async") else "main"
+            for listener in self.listeners.get(view.id(), []):
+                func = getattr(listener, handler, None)
+                if func is not None:
+                    name = "{}.{}".format(type(listener).__name__, handler)
+                    self.loop.post(thread, name, func, *args, due=due)
+
+    def apply(self, event, due):
+        kind = event["event"]
+        if kind == "open":
+            file = os.path.join(self.root, event["file"])
+            with open(file, encoding="utf-8") as fh:
+                view = View(self.window, file, fh.read())
+            self.views[event["view"]] = view
+            self.window.window_views.append(view)
+            self.listeners[view.id()] = [
+                getattr(self.plugin, name)(view)
+                for name in LISTENERS
+                if getattr(self.plugin, name).is_applicable(view.settings())
+            ]
+            self.dispatch(view, "open", due=due)
+            return
+
+        view = self.views[event["view"]]
+        if kind == "activate":
+            previous = self.window.active
+            if previous is view:
+                return
+            if previous is not None and previous.is_valid():
+                self.dispatch(previous, "deactivate", due=due)
+            self.window.active = view
+            self.dispatch(view, "activate", due=due)
+        elif kind == "modify":
+            view.insert(event["point"], event["text"])
+            self.dispatch(view, "modify", due=due)
+        elif kind == "hover":
+            self.dispatch(view, "hover", event["point"], 1, due=due)
+        elif kind == "scroll":
+            view.scrolled = max(0, min(view.size(), event["point"]))
+        elif kind == "save":
+            view.dirty = False
+            self.dispatch(view, "save", due=due)
+        elif kind == "close":
+            self.dispatch(view, "close", due=due)
+            self.loop.post("main", None, self.close, view)
+
+    def close(self, view):
+        view.valid = False
+        self.window.window_views.remove(view)
+        if self.window.active is view:
+            self.window.active = None
+
+    def run(self, trace, speed=1.0):
+        start = time.perf_counter()
+        for event in trace:
+            due = start + event["at"] / 1000 / speed
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            self.apply(event, due)
+        self.loop.settle()
+        for view in list(self.window.window_views):
+            self.apply({"event": "close", "view": self.view_name(view)}, None)
+        self.loop.settle()
+        self.plugin.plugin_unloaded()
+        self.loop.stop()
+
+    def view_name(self, view):
+        return next(name for name, other in self.views.items() if other is view)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def report(replay):
+    print("Handler latency in ms, from the event until the handler finished")
+    print(
+        "{:<55} {:>6} {:>8} {:>8} {:>8} {:>8}".format(
+            "handler", "events", "p50", "p90", "p99", "max"
+        )
+    )
+    for name, latencies in sorted(replay.loop.latencies.items()):
+        print(
+            "{:<55} {:>6} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f}".format(
+                name,
+                len(latencies),
+                1000 * statistics.median(latencies),
+                1000 * percentile(latencies, 0.9),
+                1000 * percentile(latencies, 0.99),
+                1000 * max(latencies),
+            )
+        )
+
+    print()
+    print("Backend calls")
+    for name, count in sorted(replay.calls.counts.items()):
+        print("{:<55} {:>6}".format(name, count))
+    print("{:<55} {:>6}".format("total", sum(replay.calls.counts.values())))
+
+
+def sample_files(root, count):
+    """
+    Returns the paths (relative to root) of up to count items with
+    references, and of the files that they reference.
+    """
+    paths = doorstop_cli.PathIndex(root)
+    items = []
+    files = []
+    for record in doorstop_cli.Index.load(root):
+        if len(items) == count:
+            break
+        resolved = [paths.resolve(path) for path, _, _ in record.references]
+        resolved = [file for file in resolved if file]
+        if not resolved:
+            continue
+        items.append(os.path.relpath(os.path.join(root, record.path), root))
+        if os.path.relpath(resolved[0], root) not in files:
+            files.append(os.path.relpath(resolved[0], root))
+    return items, files
+
+
+def typing_trace(root, interval=60):
+    """
+    Opens an item and types a new reference at the end of its
+    `references:` block, one character per interval.
+    """
+    items, _ = sample_files(root, 1)
+    if not items:
+        return []
+    with open(os.path.join(root, items[0]), encoding="utf-8") as fh:
+        text = fh.read()
+    block = re.search(r"^references:\n(?:[- ].*\n)*", text, re.MULTILINE)
+    if block is None:
+        return []
+
+    trace = [
+        {"at": 0, "event": "open", "view": "item", "file": items[0]},
+        {"at": 10, "event": "activate", "view": "item"},
+    ]
+    at = 500
+    # At the end of the last line of the block
+    point = block.end() - 1
+    for character in "\n- path: {}\n  type: file".format(os.path.basename(items[0])):
+        trace.append(
+            {
+                "at": at,
+                "event": "modify",
+                "view": "item",
+                "point": point,
+                "text": character,
+            }
+        )
+        at += interval
+        point += 1
+    trace.append({"at": at, "event": "hover", "view": "item", "point": block.start()})
+    return trace
+
+
+def tabs_trace(root, rounds=5, interval=100):
+    """
+    Opens a few items and the files that they reference, and
+    switches between them quickly.
+    """
+    items, files = sample_files(root, 3)
+    names = ["view{}".format(number) for number in range(len(items + files))]
+    trace = [
+        {"at": 10 * number, "event": "open", "view": name, "file": file}
+        for number, (name, file) in enumerate(zip(names, items + files))
+    ]
+    at = 500
+    for _ in range(rounds):
+        for name in names:
+            trace.append({"at": at, "event": "activate", "view": name})
+            at += interval
+    return trace
+
+
+def hover_trace(root, steps=200, interval=20):
+    """
+    Opens an item and a file that it references, and sweeps the
+    mouse over both of them.
+    """
+    items, files = sample_files(root, 1)
+    trace = []
+    at = 0
+    for name, file in zip(("item", "file"), items + files):
+        with open(os.path.join(root, file), encoding="utf-8") as fh:
+            size = len(fh.read())
+        trace.append({"at": at, "event": "open", "view": name, "file": file})
+        trace.append({"at": at + 10, "event": "activate", "view": name})
+        at += 500
+        for point in range(0, size, max(1, size // steps)):
+            trace.append({"at": at, "event": "hover", "view": name, "point": point})
+            at += interval
+    return trace
+
+
+SCENARIOS = {"typing": typing_trace, "tabs": tabs_trace, "hover": hover_trace}
+
+
+def synthesize(root, scenario):
+    if scenario != "all":
+        return SCENARIOS[scenario](root)
+    trace = []
+    offset = 0
+    for name, scenario in SCENARIOS.items():
+        events = scenario(root)
+        for event in events:
+            event = dict(event, at=event["at"] + offset)
+            if "view" in event:
+                event["view"] = "{}-{}".format(name, event["view"])
+            trace.append(event)
+        if events:
+            offset = trace[-1]["at"] + 1000
+    return trace
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--root", action="store", type=str, default=".", help="root of doorstop tree"
+    )
+    parser.add_argument(
+        "--scenario",
+        action="store",
+        choices=sorted(SCENARIOS) + ["all"],
+        default="all",
+        help="synthesize a trace of this scenario",
+    )
+    parser.add_argument(
+        "--trace", action="store", type=str, help="replay the trace in this file"
+    )
+    parser.add_argument(
+        "--save", action="store", type=str, help="save the trace to this file"
+    )
+    parser.add_argument(
+        "--speed",
+        action="store",
+        type=float,
+        default=1.0,
+        help="replay the events this many times as fast",
+    )
+    parser.add_argument(
+        "--backend",
+        action="store",
+        choices=["subprocess", "in_process", "worker"],
+        help="backend setting of the plugin",
+    )
+    parser.add_argument(
+        "--settings",
+        action="store",
+        type=json.loads,
+        default={},
+        help="other plugin settings, as a JSON object",
+    )
+    args = parser.parse_args()
+
+    root = os.path.abspath(args.root)
+    if args.trace:
+        with open(args.trace) as fh:
+            trace = json.load(fh)
+    else:
+        trace = synthesize(root, args.scenario)
+    if args.save:
+        with open(args.save, "w") as fh:
+            json.dump(trace, fh, indent=1)
+
+    settings = default_settings()
+    settings.update(python_interpreter=sys.executable, doorstop_root=root)
+    if args.backend:
+        settings["backend"] = args.backend
+    settings.update(args.settings)
+
+    replay = Replay(root, settings)
+    replay.run(trace, args.speed)
+    report(replay)
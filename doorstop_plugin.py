@@ -1,3 +1,4 @@
+import html
 import json
 from pathlib import Path
 import re
@@ -14,6 +15,26 @@ from . import doorstop_util
 DOORSTOP_KEY = "doorstop"
 settings = None
 
+# Documents with more items than this are searched in the backend as
+# you type, instead of listing all of their items
+ITEMS_LIMIT = 200
+# Number of matching items that are previewed while typing a search
+ITEMS_PREVIEW = 8
+# Milliseconds after the last keystroke before the matches are looked up
+PREVIEW_DELAY = 200
+
+# Milliseconds between checks whether a view in viewport mode was scrolled
+VIEWPORT_POLL_INTERVAL = 250
+
+# Gaps in the output of the coverage command, and how they are reported
+COVERAGE_GAPS = (
+    ("without_parents", "without parents"),
+    ("without_children", "without children"),
+    ("without_references", "without references"),
+    ("unresolved_references", "unresolved references"),
+    ("missing_links", "links to missing items"),
+)
+
 
 def trace():
     # NOTE to future me:
@@ -33,6 +54,7 @@ def plugin_loaded():
     global settings
     settings = Settings()
     doorstop_util.settings = settings
+    doorstop_util.change_listeners.append(refresh_views)
 
 
 def plugin_unloaded():
@@ -41,12 +63,100 @@ def plugin_unloaded():
     """
     global settings
     settings.remove_callbacks()
+    doorstop_util.stop_watching()
+    doorstop_util.stop_workers()
+    doorstop_util.stop_in_process()
+    doorstop_util.change_listeners.clear()
 
     for key in list(globals().keys()):
         if "doorstop" in key.lower():
             del globals()[key]
 
 
+def in_viewport_mode(view):
+    """
+    Returns whether regions should only be computed for the visible part of
+    the view, because the view is larger than the configured threshold.
+    """
+    threshold = settings.get(Setting().VIEWPORT_THRESHOLD)
+    return bool(threshold) and view.size() > threshold
+
+
+def viewport_region(view):
+    """
+    Returns the visible region of the view, extended with
+    the size of the visible region on both sides.
+    """
+    visible = view.visible_region()
+    margin = visible.size()
+    return sublime.Region(
+        max(0, visible.begin() - margin), min(view.size(), visible.end() + margin)
+    )
+
+
+def watch_viewport(view, callback):
+    """
+    Calls callback (in the async thread) each time the visible region of
+    the view changes, until the callback returns False or the view is
+    closed. Sublime Text has no scroll event, so this polls.
+    """
+    last = [None]
+
+    def poll():
+        if not view.is_valid():
+            return
+        visible = view.visible_region()
+        if (visible.begin(), visible.end()) != last[0]:
+            last[0] = (visible.begin(), visible.end())
+            if not callback():
+                return
+        sublime.set_timeout_async(poll, VIEWPORT_POLL_INTERVAL)
+
+    sublime.set_timeout_async(poll, 0)
+
+
+def refresh_views(changes):
+    """
+    Updates the regions of the open views that are affected by the
+    given ChangeSet of a watcher.
+    """
+    root = Path(changes.root)
+    for window in sublime.windows():
+        for view in window.views():
+            file_name = view.file_name()
+            if not file_name or doorstop_util.doorstop_root(view=view) != changes.root:
+                continue
+
+            references = sublime_plugin.find_view_event_listener(
+                view, DoorstopReferencesListener
+            )
+            links = sublime_plugin.find_view_event_listener(view, DoorstopLinksListener)
+            locations = sublime_plugin.find_view_event_listener(
+                view, DoorstopReferencedLocationsListener
+            )
+
+            if file_name in changes.items:
+                if references:
+                    references.update_references_regions(force=True)
+            elif references and any(
+                ref.file in changes.files
+                for ref in getattr(references, "references", [])
+            ):
+                references.update_references_regions(force=True)
+
+            if links and Path(file_name).stem in changes.uids:
+                links.dirty = True
+                links.update_links_regions()
+
+            try:
+                relpath = str(Path(file_name).relative_to(root))
+            except ValueError:
+                # Outside of the root, so no item can reference it
+                continue
+            if locations and (file_name in changes.files or relpath in changes.paths):
+                locations.update_referenced_locations()
+
+
 class DoorstopSetDoorstopPythonInterpreterCommand(sublime_plugin.ApplicationCommand):
     """
     Command to set the python interpreter in settings that will be
@@ -132,7 +242,7 @@ class DoorstopGotoAnyItemCommand(sublime_plugin.WindowCommand):
     GoTo any doorstop item.
     """
 
-    def run(self, document, item):
+    def run(self, document, item, query=None):
         self.window.open_file(item)
 
     def input(self, args):
@@ -149,13 +259,20 @@ class DoorstopGotoAnyItemCommand(sublime_plugin.WindowCommand):
 
 class DoorstopCreateReferenceCommand(sublime_plugin.TextCommand):
     """
-    Add a new reference to an existing doorstop item.
+    Add a new reference to an existing doorstop item. A reference is
+    created for each selection region.
     """
 
-    def run(self, edit, document, item):
-        reference = doorstop_util.reference(self.view)
+    def run(self, edit, document, item, query=None):
+        references = doorstop_util.references(self.view)
+        if not references:
+            return
         result = doorstop_util.doorstop(
-            self, "add_reference", "--item", item, json.dumps(reference)
+            self,
+            "add_reference",
+            "--item",
+            item,
+            *[json.dumps(reference) for reference in references],
         )
         self.view.window().open_file(result["path"])
 
@@ -172,7 +289,7 @@ class DoorstopAddLinkCommand(sublime_plugin.TextCommand):
     Links an item to the current doorstop item.
     """
 
-    def run(self, edit, document, item):
+    def run(self, edit, document, item, query=None):
         file_name = Path(self.view.file_name())
         result = doorstop_util.doorstop(self, "link", file_name.stem, item)
         self.view.window().open_file(result["path"])
@@ -185,6 +302,121 @@ class DoorstopAddLinkCommand(sublime_plugin.TextCommand):
         return doorstop_util.is_doorstop_item_file(self.view.file_name())
 
 
+class DoorstopItemsPicker:
+    """
+    Shows the items of a document in a quick panel in which multiple items
+    can be toggled. The first entry applies the selection.
+    """
+
+    def __init__(self, window, items, on_done):
+        self.window = window
+        self.items = items
+        self.on_done = on_done
+        self.selected = []
+
+    def show(self, selected_index=0):
+        entries = ["Apply to {} selected item(s)".format(len(self.selected))]
+        for item in self.items:
+            entries.append(
+                "{} {}: {}".format(
+                    "[x]" if item["uid"] in self.selected else "[ ]",
+                    item["uid"],
+                    item["text"],
+                )
+            )
+        self.window.show_quick_panel(
+            entries, self.picked, selected_index=selected_index
+        )
+
+    def picked(self, idx):
+        if idx < 0:
+            return
+        if idx == 0:
+            if self.selected:
+                self.on_done(self.selected)
+            return
+
+        uid = self.items[idx - 1]["uid"]
+        if uid in self.selected:
+            self.selected.remove(uid)
+        else:
+            self.selected.append(uid)
+        sublime.set_timeout(lambda: self.show(idx), 0)
+
+
+def show_batch_summary(window, summary):
+    if not summary:
+        return
+    if summary["errors"]:
+        sublime.error_message("\n".join(summary["errors"]))
+        return
+    window.status_message(
+        "Doorstop: changed {} item(s), {} already up to date".format(
+            len(summary["changed"]), len(summary["unchanged"])
+        )
+    )
+
+
+class DoorstopAddLinksCommand(sublime_plugin.TextCommand):
+    """
+    Links multiple items of a document to the current doorstop item
+    in one go.
+    """
+
+    def run(self, edit, document, query=None):
+        root = doorstop_util.doorstop_root(view=self.view)
+        items = DoorstopFindItemInputHandler(root, document, query=query).items()
+        if not items:
+            return
+        DoorstopItemsPicker(self.view.window(), items, self.link).show()
+
+    def link(self, uids):
+        child = Path(self.view.file_name()).stem
+        edits = [{"type": "link", "child": child, "parent": uid} for uid in uids]
+        summary = doorstop_util.doorstop(self, "batch", json.dumps(edits))
+        show_batch_summary(self.view.window(), summary)
+
+    def input(self, args):
+        root = doorstop_util.doorstop_root(view=self.view)
+        return DoorstopPickDocumentInputHandler(root)
+
+    def is_enabled(self, *args):
+        return doorstop_util.is_doorstop_item_file(self.view.file_name())
+
+
+class DoorstopCreateReferencesCommand(sublime_plugin.TextCommand):
+    """
+    Add new references (one for each selection region) to multiple
+    existing doorstop items in one go.
+    """
+
+    def run(self, edit, document, query=None):
+        root = doorstop_util.doorstop_root(view=self.view)
+        items = DoorstopFindItemInputHandler(root, document, query=query).items()
+        if not items:
+            return
+        self.references = doorstop_util.references(self.view)
+        if not self.references:
+            return
+        DoorstopItemsPicker(self.view.window(), items, self.add_references).show()
+
+    def add_references(self, uids):
+        edits = [
+            {"type": "reference", "item": uid, "reference": reference}
+            for uid in uids
+            for reference in self.references
+        ]
+        summary = doorstop_util.doorstop(self, "batch", json.dumps(edits))
+        show_batch_summary(self.view.window(), summary)
+
+    def is_enabled(self, *args):
+        return self.view.file_name() is not None
+
+    def input(self, args):
+        root = doorstop_util.doorstop_root(view=self.view)
+        return DoorstopPickDocumentInputHandler(root)
+
+
 class DoorstopFindDocumentInputHandler(sublime_plugin.ListInputHandler):
     """
     List input handler that will show a list of doorstop documents
@@ -212,8 +444,24 @@ class DoorstopFindDocumentInputHandler(sublime_plugin.ListInputHandler):
         return [item["prefix"] for item in items]
 
     def next_input(self, args):
-        if self.next_input_type:
-            return self.next_input_type(self.root, args["document"])
+        if not self.next_input_type:
+            return None
+        next_input = self.next_input_type(self.root, args["document"])
+        if next_input.is_large():
+            return DoorstopFindItemQueryInputHandler(next_input)
+        return next_input
+
+
+class DoorstopPickDocumentInputHandler(DoorstopFindDocumentInputHandler):
+    """
+    Document input of the commands that pick multiple items of the
+    document with DoorstopItemsPicker. Large documents are searched first.
+    """
+
+    def next_input(self, args):
+        items = DoorstopFindItemInputHandler(self.root, args["document"])
+        if items.is_large():
+            return DoorstopPickItemsQueryInputHandler(items)
         return None
 
 
@@ -221,27 +469,50 @@ class DoorstopFindItemInputHandler(sublime_plugin.ListInputHandler):
     """
     List input handler that will show a list of doorstop items
     for the given document name for the user to choose from.
+    When a query is given, only the best matching items are listed.
     """
 
-    def __init__(self, root, document, result_as_path=False):
+    def __init__(self, root, document, result_as_path=False, query=None):
         """
         root: str
             Root path of doorstop
         document: str
             Document prefix/name
+        query: str
+            Words that the uid or text of the items should match
         """
         self.root = root
         self.document = document
         self.result_as_path = result_as_path
+        self.query = query
 
     def name(self):
         return "item"
 
-    def list_items(self):
-        items = doorstop_util.doorstop(self.root, "items", "--prefix", self.document)
+    def request(self, query=None, limit=ITEMS_LIMIT + 1):
+        args = ["--prefix", self.document, "--limit", str(limit)]
+        if query:
+            args += ["--query", query]
+        return doorstop_util.doorstop(self.root, "items", *args)
+
+    def is_large(self):
+        """
+        Returns whether the document has more items than can be listed.
+        """
+        return len(self.request() or []) > ITEMS_LIMIT
+
+    def items(self):
+        """
+        Returns at most ITEMS_LIMIT items, the best matches of the query.
+        """
+        # Same request as is_large, so it is answered from the recent results
+        items = self.request(self.query)
         if not items:
             return []
+        return items[:ITEMS_LIMIT]
 
+    def list_items(self):
+        items = self.items()
         return [
             (
                 "{}: {}".format(item["uid"], item["text"]),
@@ -252,8 +523,69 @@ class DoorstopFindItemInputHandler(sublime_plugin.ListInputHandler):
 
 
 class DoorstopFindItemPathInputHandler(DoorstopFindItemInputHandler):
-    def __init__(self, root, document):
-        super().__init__(root, document, result_as_path=True)
+    def __init__(self, root, document, query=None):
+        super().__init__(root, document, result_as_path=True, query=query)
+
+
+class DoorstopFindItemQueryInputHandler(sublime_plugin.TextInputHandler):
+    """
+    Text input handler for searching the items of a large document. The
+    best matches are previewed while typing, and listed by the given item
+    input handler after confirming. Matches are looked up in the
+    background once typing pauses, the preview shows them from then on.
+    """
+
+    def __init__(self, item_input):
+        self.item_input = item_input
+        # query -> matching items of the lookups that are done
+        self.matches = {}
+        self.latest = None
+
+    def name(self):
+        return "query"
+
+    def placeholder(self):
+        return "Search {} items by uid or text".format(self.item_input.document)
+
+    def preview(self, text):
+        query = text.strip()
+        if not query:
+            return None
+        if query not in self.matches:
+            self.latest = query
+            sublime.set_timeout_async(lambda: self.look_up(query), PREVIEW_DELAY)
+            return "Searching..."
+        items = self.matches[query]
+        if not items:
+            return "No matching items"
+        if not hasattr(sublime, "Html"):
+            # Sublime Text 3 only previews plain text
+            return ", ".join(item["uid"] for item in items)
+        return sublime.Html(
+            "<br>".join(
+                "<b>{}</b>: {}".format(item["uid"], html.escape(item["text"]))
+                for item in items
+            )
+        )
+
+    def look_up(self, query):
+        # Skip the queries that were typed over in the meantime
+        if query == self.latest and query not in self.matches:
+            self.matches[query] = self.item_input.request(query, ITEMS_PREVIEW)
+
+    def next_input(self, args):
+        self.item_input.query = args["query"]
+        return self.item_input
+
+
+class DoorstopPickItemsQueryInputHandler(DoorstopFindItemQueryInputHandler):
+    """
+    Query input of DoorstopPickDocumentInputHandler. The command lists the
+    best matches in DoorstopItemsPicker, instead of an item input.
+    """
+
+    def next_input(self, args):
+        return None
 
 
 class DoorstopReferencedLocationsListener(sublime_plugin.ViewEventListener):
@@ -274,13 +606,28 @@ class DoorstopReferencedLocationsListener(sublime_plugin.ViewEventListener):
         """
         Called when a view gains input focus.
         """
+        # Activation forces an update, unless the watcher keeps
+        # the results up to date
+        root = doorstop_util.doorstop_root(view=self.view)
+        if not doorstop_util.is_watched(root):
+            state = doorstop_util.buffer_state(self.view)
+            state.drop("referenced")
+            state.drop("referencing")
         self.update_referenced_locations()
 
+    def on_deactivated_async(self):
+        """
+        Called when a view loses input focus.
+        """
+        doorstop_util.cancel_requests(self.view)
+
     def on_close(self):
         """
         Called when a view loses input focus.
         """
         self.erase_regions()
+        doorstop_util.cancel_requests(self.view)
+        doorstop_util.release_buffer_state(self.view)
 
     def erase_regions(self):
         self.view.erase_regions("doorstop:referenced")
@@ -297,34 +644,196 @@ class DoorstopReferencedLocationsListener(sublime_plugin.ViewEventListener):
         root = doorstop_util.doorstop_root(view=self.view)
         if not path or not root:
             return
+        try:
+            relpath = str(Path(path).relative_to(root))
+        except ValueError:
+            return
+
+        # Skip the backend for files that no item references
+        if not doorstop_util.is_referenced(root, relpath):
+            self.referenced = []
+            self.erase_regions()
+            return
+
+        state = doorstop_util.buffer_state(self.view)
+        token = doorstop_util.new_request(self.view, "referenced")
+        if in_viewport_mode(self.view):
+            self.referenced = []
+            self.covered = []
+            watch_viewport(
+                self.view,
+                lambda: self.extend_referenced_locations(path, root, token),
+            )
+            return
+
+        referenced = state.get(
+            self.view,
+            "referenced",
+            lambda: self.find_referenced(path, root, token),
+            token=token,
+        )
+        # Drop the results when the user has moved on in the meantime
+        if referenced is None or not token.is_current():
+            return
+
+        self.referenced = referenced
+        self.view.add_regions(
+            "doorstop:referenced",
+            [region for item in self.referenced for region in item.get("regions", [])],
+            "string",
+            "bookmark",
+            sublime.DRAW_NO_FILL,
+        )
 
+    def extend_referenced_locations(self, path, root, token):
+        """
+        Finds the referenced locations in the visible part of the view (and
+        a margin around it), unless that part was searched before, and adds
+        them to the drawn regions. The referencing items are only looked up
+        once per buffer state. Returns False when the request was
+        superseded, which stops watching the viewport.
+        """
+        if not token.is_current():
+            return False
+        region = viewport_region(self.view)
+        if any(covered.contains(region) for covered in self.covered):
+            return True
+
+        state = doorstop_util.buffer_state(self.view)
+        items = state.get(
+            self.view,
+            "referencing",
+            lambda: self.referencing_items(path, root, token),
+            token=token,
+        )
+        if items is None or not token.is_current():
+            return token.is_current()
+        found = self.locate_referenced([dict(item) for item in items], region)
+
+        by_keyword = {
+            (item["uid"], item.get("keyword")): item for item in self.referenced
+        }
+        for item in found:
+            key = (item["uid"], item.get("keyword"))
+            if key not in by_keyword:
+                by_keyword[key] = item
+                continue
+            existing = by_keyword[key]
+            regions = existing.get("regions", []) + [
+                region
+                for region in item.get("regions", [])
+                if region not in existing.get("regions", [])
+            ]
+            if regions:
+                existing["regions"] = sorted(regions, key=lambda region: region.begin())
+                existing["region"] = existing["regions"][0]
+
+        self.covered.append(region)
+        self.referenced = list(by_keyword.values())
+        self.view.add_regions(
+            "doorstop:referenced",
+            [region for item in self.referenced for region in item.get("regions", [])],
+            "string",
+            "bookmark",
+            sublime.DRAW_NO_FILL,
+        )
+        return True
+
+    def find_referenced(self, path, root, token=None):
+        """
+        Returns the items that reference the file, with the regions of their
+        keywords in the view.
+        """
+        items = self.referencing_items(path, root, token)
+        if items is None:
+            return None
+        return self.locate_referenced(items)
+
+    def referencing_items(self, path, root, token=None):
+        """
+        Returns the items that reference the file. The backend resolves the
+        keyword locations of saved files, only the keywords in views with
+        unsaved changes are searched for here.
+        """
         file = Path(path).relative_to(Path(root))
 
-        items = doorstop_util.doorstop(
+        args = [str(file)]
+        if not self.view.is_dirty():
+            args.insert(0, "--locations")
+        return doorstop_util.doorstop(
             self,
             "find_references",
-            str(file),
+            *args,
+            token=token,
         )
+
+    def locate_referenced(self, items, region=None):
+        """
+        Adds the regions of the keywords in the view to the items. Only the
+        occurrences inside the given region are added, when given. Without
+        highlight_all_occurrences, that is the first occurrence in the view,
+        if it is inside the region.
+        """
+        whole_view = region is None
+        if whole_view:
+            region = sublime.Region(0, self.view.size())
+        all_occurrences = settings.get(Setting().ALL_OCCURRENCES)
+
+        found = {}
+        search = []
+        for item in items:
+            keyword = item.get("keyword")
+            if not keyword:
+                continue
+            if item.get("locations") is not None:
+                spans = [
+                    (location["offset"], location["offset"] + len(keyword))
+                    for location in item["locations"]
+                ]
+            elif all_occurrences or whole_view:
+                search.append(keyword)
+                continue
+            else:
+                # The first occurrence in the view, wherever it is scrolled to
+                first = self.view.find(keyword, 0, sublime.LITERAL)
+                if first.begin() < 0:
+                    continue
+                spans = [(first.begin(), first.end())]
+            if not all_occurrences:
+                spans = spans[:1]
+            spans = [
+                (begin, end)
+                for begin, end in spans
+                if region.contains(sublime.Region(begin, end))
+            ]
+            if spans:
+                found[keyword] = spans
+        if search:
+            searched = doorstop_util.find_keywords(
+                self.view.substr(region), search, all_occurrences=all_occurrences
+            )
+            for keyword, spans in searched.items():
+                found[keyword] = [
+                    (region.begin() + begin, region.begin() + end)
+                    for begin, end in spans
+                ]
+
         for item in items:
             keyword = item.get("keyword")
 
             if not keyword:
                 continue
 
-            region = self.view.find(keyword.replace("(", "\\(").replace(")", "\\)"), 0)
-            if region.begin() == -1:
-                print("Could not find keyword: '{}'".format(keyword))
+            if keyword not in found:
+                if whole_view:
+                    print("Could not find keyword: '{}'".format(keyword))
                 continue
-            item["region"] = region
+            item["regions"] = [
+                sublime.Region(begin, end) for begin, end in found[keyword]
+            ]
+            item["region"] = item["regions"][0]
 
-        self.referenced = items
-        self.view.add_regions(
-            "doorstop:referenced",
-            [item["region"] for item in self.referenced if "region" in item],
-            "string",
-            "bookmark",
-            sublime.DRAW_NO_FILL,
-        )
+        return items
 
     def on_hover(self, point, hover_zone):
         """
@@ -334,7 +843,9 @@ class DoorstopReferencedLocationsListener(sublime_plugin.ViewEventListener):
             return
 
         hovered_referenced = [
-            ref for ref in self.referenced if ref["region"].contains(point)
+            ref
+            for ref in self.referenced
+            if any(region.contains(point) for region in ref.get("regions", []))
         ]
         if not hovered_referenced:
             return
@@ -417,6 +928,7 @@ class DoorstopReferencesListener(sublime_plugin.ViewEventListener):
         Called when a view loses input focus.
         """
         self.erase_regions()
+        doorstop_util.release_buffer_state(self.view)
 
     def on_modified_async(self):
         """
@@ -430,6 +942,13 @@ class DoorstopReferencesListener(sublime_plugin.ViewEventListener):
         self.view.erase_regions("doorstop:references:valid")
 
     def update_references_regions(self, force=False):
+        if in_viewport_mode(self.view):
+            token = doorstop_util.new_request(self.view, "references")
+            self.references = []
+            self.covered = []
+            watch_viewport(self.view, lambda: self.extend_references_regions(token))
+            return
+
         regions = regions_for_items_in_yaml_list(self.view, "references")
         if regions is None:
             self.erase_regions()
@@ -447,10 +966,54 @@ class DoorstopReferencesListener(sublime_plugin.ViewEventListener):
             if len(refs) == len(self.references):
                 return
 
-        self.references = [
-            doorstop_util.region_to_reference(self.view, region) for region in regions
+        # Activation forces an update, unless the watcher keeps
+        # the results up to date
+        root = doorstop_util.doorstop_root(view=self.view)
+        state = doorstop_util.buffer_state(self.view)
+        self.references = state.get(
+            self.view,
+            "references",
+            lambda: [
+                doorstop_util.region_to_reference(self.view, region)
+                for region in regions
+            ],
+            force=force and not doorstop_util.is_watched(root),
+        )
+        self.draw_references_regions()
+
+    def extend_references_regions(self, token):
+        """
+        Looks up the references in the visible part of the view (and a
+        margin around it), unless that part was done before, and adds them
+        to the drawn regions. Returns False when the request was superseded,
+        which stops watching the viewport.
+        """
+        if not token.is_current():
+            return False
+        region = viewport_region(self.view)
+        if any(covered.contains(region) for covered in self.covered):
+            return True
+
+        regions = regions_for_items_in_yaml_list(self.view, "references", within=region)
+        if regions is None:
+            self.erase_regions()
+            return False
+
+        known = {(ref.region.begin(), ref.region.end()) for ref in self.references}
+        references = [
+            doorstop_util.region_to_reference(self.view, region)
+            for region in regions
+            if (region.begin(), region.end()) not in known
         ]
+        if not token.is_current():
+            return False
 
+        self.covered.append(region)
+        self.references = self.references + references
+        self.draw_references_regions()
+        return True
+
+    def draw_references_regions(self):
         self.view.add_regions(
             "doorstop:references:valid",
             [ref.region for ref in self.references if ref.is_valid()],
@@ -523,6 +1086,189 @@ class DoorstopGotoReferenceCommand(sublime_plugin.TextCommand):
         return len(self.view.get_regions("doorstop:references:valid")) >= 1
 
 
+class DoorstopValidateReferencesCommand(sublime_plugin.WindowCommand):
+    """
+    Checks all references of all items in the tree and lists the invalid
+    ones in an output panel. Results can be navigated like build results.
+    """
+
+    PANEL = "doorstop_references"
+
+    def run(self):
+        root = doorstop_util.doorstop_root(
+            view=self.window.active_view(), window=self.window
+        )
+        panel = self.window.create_output_panel(self.PANEL)
+        panel.settings().set("result_file_regex", r"^(.+?):(\d+): ")
+        panel.settings().set("result_base_dir", root)
+        panel.settings().set("word_wrap", False)
+        self.window.run_command("show_panel", {"panel": "output." + self.PANEL})
+        self.append(panel, "Validating references in {}\n".format(root))
+        sublime.set_timeout_async(lambda: self.validate(root, panel), 0)
+
+    def validate(self, root, panel):
+        for result in doorstop_util.doorstop_stream(root, "validate_references"):
+            if "summary" in result:
+                self.append(
+                    panel,
+                    "Checked {checked} references, {invalid} invalid\n".format(
+                        **result["summary"]
+                    ),
+                )
+                continue
+
+            reference = result["reference"]
+            target = reference.get("path")
+            if reference.get("keyword"):
+                target += " ({})".format(reference["keyword"])
+            self.append(
+                panel,
+                "{}:{}: {}: {}: {}\n".format(
+                    Path(result["path"]).relative_to(root),
+                    result["row"],
+                    result["uid"],
+                    target,
+                    result["message"],
+                ),
+            )
+
+    def append(self, panel, text):
+        panel.run_command(
+            "append", {"characters": text, "force": True, "scroll_to_end": True}
+        )
+
+    def is_enabled(self, *args):
+        return doorstop_util.is_doorstop_configured(
+            view=self.window.active_view(), window=self.window
+        )
+
+
+class DoorstopCoverageCommand(sublime_plugin.WindowCommand):
+    """
+    Reports the gaps in the traceability of the whole tree, grouped by
+    document, in an output panel. Results can be navigated like build
+    results.
+    """
+
+    PANEL = "doorstop_coverage"
+
+    def run(self):
+        root = doorstop_util.doorstop_root(
+            view=self.window.active_view(), window=self.window
+        )
+        panel = self.window.create_output_panel(self.PANEL)
+        panel.settings().set("result_file_regex", r"^\s*(.+?):(\d+): ")
+        panel.settings().set("result_base_dir", root)
+        panel.settings().set("word_wrap", False)
+        self.window.run_command("show_panel", {"panel": "output." + self.PANEL})
+        panel.run_command(
+            "append",
+            {"characters": "Checking coverage of {}\n".format(root), "force": True},
+        )
+        sublime.set_timeout_async(lambda: self.report(root, panel), 0)
+
+    def report(self, root, panel):
+        result = doorstop_util.doorstop(root, "coverage")
+        if not result:
+            return
+
+        def location(item):
+            return "{}:{}: {}".format(
+                Path(item["path"]).relative_to(root), item.get("row", 1), item["uid"]
+            )
+
+        lines = []
+        for prefix, document in result["documents"].items():
+            counts = ", ".join(
+                "{} {}".format(document["counts"][gap], description)
+                for gap, description in COVERAGE_GAPS
+            )
+            lines.append("{} ({} items): {}".format(prefix, document["items"], counts))
+            for item in document["without_parents"]:
+                lines.append("  {}: without parents".format(location(item)))
+            for item in document["without_children"]:
+                lines.append("  {}: without children".format(location(item)))
+            for item in document["without_references"]:
+                lines.append("  {}: without references".format(location(item)))
+            for item in document["unresolved_references"]:
+                lines.append(
+                    "  {}: {}: path does not resolve".format(
+                        location(item), item["reference"]
+                    )
+                )
+            for item in document["missing_links"]:
+                lines.append(
+                    "  {}: {}: linked item does not exist".format(
+                        location(item), item["link"]
+                    )
+                )
+
+        total = result["total"]
+        lines.append(
+            "Checked {} items: {}".format(
+                total["items"],
+                ", ".join(
+                    "{} {}".format(total[gap], description)
+                    for gap, description in COVERAGE_GAPS
+                ),
+            )
+        )
+        panel.run_command(
+            "append", {"characters": "\n".join(lines) + "\n", "force": True}
+        )
+
+    def is_enabled(self, *args):
+        return doorstop_util.is_doorstop_configured(
+            view=self.window.active_view(), window=self.window
+        )
+
+
+class DoorstopExportMatrixCommand(sublime_plugin.WindowCommand):
+    """
+    Exports the traceability matrix (item -> child items -> references)
+    of the whole tree to a CSV or JSON lines file.
+    """
+
+    def run(self, format):
+        self.format = format
+        self.root = doorstop_util.doorstop_root(
+            view=self.window.active_view(), window=self.window
+        )
+        self.window.show_input_panel(
+            "Export traceability matrix to",
+            str(Path(self.root) / "traceability.{}".format(format)),
+            lambda path: sublime.set_timeout_async(lambda: self.export(path), 0),
+            None,
+            None,
+        )
+
+    def export(self, path):
+        self.window.status_message("Doorstop: exporting traceability matrix...")
+        result = doorstop_util.doorstop(
+            self.root, "matrix", "--format", self.format, "--output", path
+        )
+        if result:
+            self.window.status_message(
+                "Doorstop: exported {} rows to {}".format(result["rows"], path)
+            )
+
+    def input(self, args):
+        return DoorstopMatrixFormatInputHandler()
+
+    def is_enabled(self, *args):
+        return doorstop_util.is_doorstop_configured(
+            view=self.window.active_view(), window=self.window
+        )
+
+
+class DoorstopMatrixFormatInputHandler(sublime_plugin.ListInputHandler):
+    def name(self):
+        return "format"
+
+    def list_items(self):
+        return [("CSV", "csv"), ("JSON lines", "jsonl")]
+
+
 class DoorstopGotoAnyLinkCommand(sublime_plugin.TextCommand):
     """
     Text command that shows a list of all the links from and to this doorstop item
@@ -564,6 +1310,80 @@ class DoorstopGotoAnyLinkCommand(sublime_plugin.TextCommand):
         self.view.window().open_file(item["path"], sublime.TRANSIENT)
 
 
+class DoorstopShowTraceCommand(sublime_plugin.TextCommand):
+    """
+    Text command that shows all ancestors (^) and descendants (v) of this
+    doorstop item as trees, followed by all references (#) of the item and
+    its descendants.
+    """
+
+    def run(self, edit, depth=0):
+        file_name = Path(self.view.file_name())
+        trace = doorstop_util.doorstop(
+            self, "trace", "--item", file_name.stem, "--depth", str(depth)
+        )
+        if not trace:
+            return
+
+        self.targets = []
+        entries = []
+        for node in trace["ancestors"]:
+            entries.append(
+                "{}^ {}: {}".format(
+                    "  " * (node["depth"] - 1),
+                    node["uid"],
+                    # Links to missing items only have a uid
+                    node.get("text", "(missing item)"),
+                )
+            )
+            self.targets.append(node.get("path"))
+
+        item = trace["item"]
+        entries.append("{}: {}".format(item["uid"], item["text"]))
+        self.targets.append(item["path"])
+
+        for node in trace["descendants"]:
+            entries.append(
+                "{}v {}: {}".format(
+                    "  " * (node["depth"] - 1),
+                    node["uid"],
+                    node.get("text", "(missing item)"),
+                )
+            )
+            self.targets.append(node.get("path"))
+
+        for result in trace["references"]:
+            reference = result["reference"]
+            target = reference["path"]
+            if reference.get("keyword"):
+                target += " ({})".format(reference["keyword"])
+            entries.append("# {}: {}".format(result["uid"], target))
+            self.targets.append(reference)
+
+        self.view.window().show_quick_panel(
+            entries, self.goto, sublime.MONOSPACE_FONT, len(trace["ancestors"])
+        )
+
+    def goto(self, idx):
+        if idx < 0 or not self.targets[idx]:
+            return
+
+        target = self.targets[idx]
+        if isinstance(target, str):
+            self.view.window().open_file(target, sublime.TRANSIENT)
+            return
+
+        root = doorstop_util.doorstop_root(view=self.view)
+        location = doorstop_util.locate_reference(root, target)
+        if location:
+            self.view.window().open_file(
+                location, sublime.ENCODED_POSITION | sublime.TRANSIENT
+            )
+
+    def is_enabled(self, *args):
+        return doorstop_util.is_doorstop_item_file(self.view.file_name())
+
+
 class DoorstopLinksListener(sublime_plugin.ViewEventListener):
     """
     ViewEventListener that will try to find link from and to
@@ -602,18 +1422,27 @@ class DoorstopLinksListener(sublime_plugin.ViewEventListener):
         """
         self.update_links_regions()
 
+    def on_deactivated_async(self):
+        """
+        Called when a view loses input focus.
+        """
+        doorstop_util.cancel_requests(self.view)
+
     def on_close(self):
         """
         Called when a view is closed (note, there may still be other views into
         the same buffer).
         """
-        self.view.erase_regions("doorstop:links")
+        self.erase_links_regions()
+        doorstop_util.cancel_requests(self.view)
+        doorstop_util.release_buffer_state(self.view)
 
     def on_hover(self, point, hover_zone):
         """
         Called when the user's mouse hovers over a view for a short period.
         """
         regions = self.view.get_regions("doorstop:links:direct")
+        regions += self.view.get_regions("doorstop:links:direct:suspect")
         hovered_regions = [region for region in regions if region.contains(point)]
         if hovered_regions:
             direct_links = self.direct_links
@@ -621,9 +1450,14 @@ class DoorstopLinksListener(sublime_plugin.ViewEventListener):
             items = [link for link in direct_links if link["uid"] == item_uid]
             if items and len(items) == 1:
                 item = items[0]
+                suspect = ""
+                if item_uid in self.suspect_links:
+                    suspect = "<br>Suspect link: {} changed since it was linked".format(
+                        item_uid
+                    )
                 self.view.show_popup(
-                    "<a href='{}'>{}: {}</a>".format(
-                        item["path"], item["uid"], item["text"]
+                    "<a href='{}'>{}: {}</a>{}".format(
+                        item["path"], item["uid"], item["text"], suspect
                     ),
                     sublime.HIDE_ON_MOUSE_MOVE_AWAY,
                     point,
@@ -693,20 +1527,103 @@ class DoorstopLinksListener(sublime_plugin.ViewEventListener):
         if hasattr(self, "dirty") and not self.dirty:
             return
 
+        token = doorstop_util.new_request(self.view, "links")
+        state = doorstop_util.buffer_state(self.view)
+        links = state.get(
+            self.view, "links", lambda: self.find_links(token), token=token
+        )
+        # Drop the results when the user has moved on in the meantime,
+        # the view stays dirty so that they are looked up again
+        if not token.is_current():
+            return
+        if links is None:
+            self.erase_links_regions()
+            return
+
+        self.direct_links = links["direct_links"]
+        self.suspect_links = links["suspect_links"]
+        self.parents = links["parents"]
+        self.children = links["children"]
+        self.other = links["other"]
+
+        self.view.add_regions(
+            "doorstop:links:direct",
+            links["uid_link_regions"],
+            "string",  # keyword seems to be orange
+            "",
+            sublime.DRAW_NO_FILL
+            | sublime.DRAW_NO_OUTLINE
+            | sublime.DRAW_SOLID_UNDERLINE,
+        )
+        self.view.add_regions(
+            "doorstop:links:direct:suspect",
+            links["suspect_link_regions"],
+            "markup.changed",
+            "",
+            sublime.DRAW_NO_FILL
+            | sublime.DRAW_NO_OUTLINE
+            | sublime.DRAW_SQUIGGLY_UNDERLINE,
+        )
+        self.view.add_regions(
+            "doorstop:links:direct:invalid",
+            links["invalid_link_regions"],
+            "invalid",  # keyword seems to be orange
+            "",
+            sublime.DRAW_NO_FILL
+            | sublime.DRAW_NO_OUTLINE
+            | sublime.DRAW_SOLID_UNDERLINE,
+        )
+
+        is_linked = self.parents or self.children or self.other
+        self.view.add_regions(
+            "doorstop:links",
+            [links["links_region"]],
+            "string" if is_linked or not links["is_normative"] else "invalid",
+            "bookmark",
+            sublime.DRAW_NO_FILL
+            | sublime.DRAW_NO_OUTLINE
+            | sublime.DRAW_SOLID_UNDERLINE,
+        )
+
+        self.dirty = False
+
+    def erase_links_regions(self):
+        self.view.erase_regions("doorstop:links")
+        self.view.erase_regions("doorstop:links:direct")
+        self.view.erase_regions("doorstop:links:direct:suspect")
+        self.view.erase_regions("doorstop:links:direct:invalid")
+
+    def find_links(self, token=None):
+        """
+        Looks up the direct links and the parents, children and other linked
+        items of the item in the buffer. Returns None when the buffer has no
+        (single) links attribute, or when a backend call failed (timed out,
+        or was superseded), so that the result isn't kept.
+        """
         links_regions = self.view.find_all(r"^links")
         if len(links_regions) != 1:
-            self.view.erase_regions("doorstop:links")
-            return
+            return None
 
         link_regions = regions_for_items_in_yaml_list(self.view, "links")
         if link_regions is None:
-            self.view.erase_regions("doorstop:links:direct")
-            self.view.erase_regions("doorstop:links:direct:invalid")
             link_regions = []
 
+        # Links of which the linked item changed since they were stamped
+        status = doorstop_util.doorstop(
+            self,
+            "link_status",
+            "--item",
+            Path(self.view.file_name()).stem,
+            token=token,
+        )
+        if status is None:
+            return None
+        suspect_links = {link["uid"] for link in status if link["status"] == "suspect"}
+
         uid_link_regions = []
+        suspect_link_regions = []
         invalid_link_regions = []
-        self.direct_links = []
+        direct_links = []
         for region in link_regions:
             content = self.view.substr(region)
             try:
@@ -714,10 +1631,16 @@ class DoorstopLinksListener(sublime_plugin.ViewEventListener):
                 uid_region = sublime.Region(region.begin() + 2, region.begin() + index)
                 item_uid = self.view.substr(uid_region)
                 try:
-                    item = doorstop_util.doorstop(self, "item", item_uid)
-                    self.direct_links.append(item)
+                    item = doorstop_util.doorstop(self, "item", item_uid, token=token)
+                    if item is None:
+                        # Timed out or superseded, so unknown
+                        return None
+                    direct_links.append(item)
                     # Valid region
-                    uid_link_regions.append(uid_region)
+                    if item_uid in suspect_links:
+                        suspect_link_regions.append(uid_region)
+                    else:
+                        uid_link_regions.append(uid_region)
                 except Exception:
                     invalid_link_regions.append(uid_region)
                     continue
@@ -726,32 +1649,9 @@ class DoorstopLinksListener(sublime_plugin.ViewEventListener):
                     sublime.Region(region.begin() + 2, region.end())
                 )
 
-        self.view.add_regions(
-            "doorstop:links:direct",
-            uid_link_regions,
-            "string",  # keyword seems to be orange
-            "",
-            sublime.DRAW_NO_FILL
-            | sublime.DRAW_NO_OUTLINE
-            | sublime.DRAW_SOLID_UNDERLINE,
-        )
-        self.view.add_regions(
-            "doorstop:links:direct:invalid",
-            invalid_link_regions,
-            "invalid",  # keyword seems to be orange
-            "",
-            sublime.DRAW_NO_FILL
-            | sublime.DRAW_NO_OUTLINE
-            | sublime.DRAW_SOLID_UNDERLINE,
-        )
-
         file_name = Path(self.view.file_name())
         item = file_name.stem
 
-        self.parents = doorstop_util.doorstop(self, "parents", "--item", item)
-        self.children = doorstop_util.doorstop(self, "children", "--item", item)
-        self.other = doorstop_util.doorstop(self, "linked", "--item", item)
-
         is_normative = True
         normative_region = self.view.find_all(r"^normative:.*$")
         if len(normative_region) == 1 and "true" not in self.view.substr(
@@ -759,26 +1659,39 @@ class DoorstopLinksListener(sublime_plugin.ViewEventListener):
         ):
             is_normative = False
 
-        links_region = links_regions[0]
-        self.view.add_regions(
-            "doorstop:links",
-            [links_region],
-            "string"
-            if self.parents or self.children or self.other or not is_normative
-            else "invalid",
-            "bookmark",
-            sublime.DRAW_NO_FILL
-            | sublime.DRAW_NO_OUTLINE
-            | sublime.DRAW_SOLID_UNDERLINE,
-        )
-
-        self.dirty = False
+        linked = {}
+        for key, cmd in (
+            ("parents", "parents"),
+            ("children", "children"),
+            ("other", "linked"),
+        ):
+            linked[key] = doorstop_util.doorstop(self, cmd, "--item", item, token=token)
+            if linked[key] is None:
+                return None
+
+        return {
+            "links_region": links_regions[0],
+            "uid_link_regions": uid_link_regions,
+            "suspect_link_regions": suspect_link_regions,
+            "suspect_links": suspect_links,
+            "invalid_link_regions": invalid_link_regions,
+            "direct_links": direct_links,
+            "parents": linked["parents"],
+            "children": linked["children"],
+            "other": linked["other"],
+            "is_normative": is_normative,
+        }
 
     def link_href_clicked(self, href):
         self.view.window().open_file(href, sublime.TRANSIENT)
 
 
-def regions_for_items_in_yaml_list(view, keyword):
+def regions_for_items_in_yaml_list(view, keyword, within=None):
+    """
+    Returns the regions of the items in the yaml list with the given keyword,
+    or None when the view doesn't have (exactly one) such list. With within,
+    only the items that start inside that region are searched for.
+    """
     keyword_regions = view.find_all("^{}:$".format(keyword))
     if len(keyword_regions) != 1:
         return None
@@ -793,8 +1706,21 @@ def regions_for_items_in_yaml_list(view, keyword):
             attribute_after_references = x
             break
 
+    pattern = r"(?s)*(^- .*?)(?:(?!^[-|\w]).)*"
+    if within is None:
+        items = view.find_all(pattern)
+    else:
+        items = []
+        point = view.line(max(keyword_region.begin(), within.begin())).begin()
+        end = min(within.end(), attribute_after_references.begin())
+        while point <= end:
+            item = view.find(pattern, point)
+            if item.begin() < 0 or item.begin() > end:
+                break
+            items.append(item)
+            point = max(item.end(), point + 1)
+
     regions = []
-    items = view.find_all(r"(?s)*(^- .*?)(?:(?!^[-|\w]).)*")
     for item in items:
         if item.begin() < keyword_region.begin():
             continue
@@ -1,6 +1,20 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import copy
+import importlib.util
+import io
 import json
+import mmap
+import os
 from pathlib import Path
+import queue
+import re
+import struct
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 import yaml
 
 import sublime
@@ -10,6 +24,15 @@ class Setting:
     def __init__(self):
         self.INTERPRETER = "python_interpreter"
         self.ROOT = "doorstop_root"
+        self.WATCH_INTERVAL = "watch_interval"
+        self.ALL_OCCURRENCES = "highlight_all_occurrences"
+        self.BACKEND = "backend"
+        self.SITE_PACKAGES = "site_packages"
+        self.TIMEOUT = "backend_timeout"
+        self.VIEWPORT_THRESHOLD = "viewport_threshold"
+        self.MAX_BACKENDS = "max_backends"
+        self.BACKEND_MEMORY = "backend_memory_limit"
+        self.BACKEND_IDLE = "backend_idle_timeout"
 
     def __iter__(self):
         for x in dir(self):
@@ -19,6 +42,29 @@ class Setting:
 
 FILENAME = "Doorstop.sublime-settings"
 
+# Read commands whose results are cached while the root is watched
+CACHED_COMMANDS = (
+    "item",
+    "find_references",
+    "parents",
+    "children",
+    "linked",
+    "link_status",
+)
+# Read commands that are answered from the mapped index file when possible
+INDEX_COMMANDS = ("item", "find_references", "parents")
+# Commands that change item files
+WRITE_COMMANDS = ("add_reference", "add_item", "link", "batch")
+# Commands that aren't aborted after the backend timeout: writes, which
+# shouldn't be interrupted, and exports and reports of the whole tree,
+# which take long on big trees
+UNTIMED_COMMANDS = WRITE_COMMANDS + ("matrix", "coverage")
+# Number of recent read results that are kept, and for how many seconds
+RECENT_RESULTS_SIZE = 128
+RECENT_RESULTS_TTL = 5
+# Directories that are skipped when looking for doorstop documents
+EXCLUDE_DIRNAMES = {".git", ".tox", ".venv", "venv"}
+
 
 class Settings:
     """
@@ -151,34 +197,81 @@ def find_git(path):
             return path
 
 
-def reference(view):
-    # Check the selection
-    keyword = None
-    selection = view.sel()
-    if len(selection) == 1:
+def references(view):
+    """
+    Returns a reference to the current file for each selection region that
+    contains text, with the (first line of the) selected text as keyword.
+    Returns a single reference without keyword when nothing is selected.
+    """
+    keywords = []
+    for region in view.sel():
         # Only take the first line of the selection, if the
         # selection is multiline
-        selected_text = view.substr(selection[0]).split("\n")[0]
-        if len(selected_text) > 0:
-            keyword = selected_text
+        selected_text = view.substr(region).split("\n")[0]
+        if len(selected_text) > 0 and selected_text not in keywords:
+            keywords.append(selected_text)
 
     # Create paths
     project_dir = doorstop_root(view=view)
     current_file = view.window().extract_variables().get("file")
     if not current_file:
-        return None
+        return []
 
     relative = Path(current_file).relative_to(project_dir)
-    result = {
-        "path": str(relative),
-        "type": "file",
-    }
-    if keyword:
-        result["keyword"] = keyword
+    result = []
+    for keyword in keywords or [None]:
+        reference = {
+            "path": str(relative),
+            "type": "file",
+        }
+        if keyword:
+            reference["keyword"] = keyword
+        result.append(reference)
     return result
 
 
-def doorstop(item, cmd, *args):
+def find_keywords(text, keywords, all_occurrences=False):
+    """
+    Finds the (literal) keywords in text in a single pass, with one combined
+    pattern of all escaped keywords. Returns a dict of keyword -> list of
+    (begin, end) tuples, which only holds the first occurrence of each
+    keyword unless all_occurrences is set.
+    """
+    # Longest first, so that a keyword that is part of a longer
+    # keyword doesn't hide the longer one
+    keywords = sorted({keyword for keyword in keywords if keyword}, key=len)[::-1]
+    result = {}
+    if not keywords:
+        return result
+
+    pattern = re.compile("|".join(re.escape(keyword) for keyword in keywords))
+    remaining = set(keywords)
+    for match in pattern.finditer(text):
+        keyword = match.group(0)
+        if keyword in result and not all_occurrences:
+            continue
+        result.setdefault(keyword, []).append(match.span())
+        remaining.discard(keyword)
+        if not remaining and not all_occurrences:
+            break
+
+    # Keywords that only occur inside matches of other keywords
+    for keyword in remaining:
+        begin = text.find(keyword)
+        while begin != -1:
+            result.setdefault(keyword, []).append((begin, begin + len(keyword)))
+            if not all_occurrences:
+                break
+            begin = text.find(keyword, begin + 1)
+    return result
+
+
+def doorstop(item, cmd, *args, token=None):
+    """
+    Runs a backend command and returns its parsed JSON result. When a
+    RequestToken is given, the call is aborted as soon as the token is
+    superseded, and None is returned.
+    """
     if isinstance(item, str):
         root = item
     else:
@@ -187,15 +280,172 @@ def doorstop(item, cmd, *args):
         except Exception:
             root = doorstop_root(window=item.window)
 
-    json_result = _run_doorstop_command(["--root", root] + [cmd] + list(args))
+    watch(root)
+    if cmd in INDEX_COMMANDS:
+        result = _from_index_file(root, cmd, args)
+        if result is not None:
+            return result
+
+    key = (root, cmd, args)
+    if cmd in CACHED_COMMANDS and root in _watchers:
+        with _cache_lock:
+            if key in _results:
+                return copy.deepcopy(_results[key])
+
+    command = ["--root", root] + [cmd] + list(args)
+    if cmd in UNTIMED_COMMANDS:
+        json_result = _run_doorstop_command(command, token=token)
+    else:
+        timeout = settings.get(Setting().TIMEOUT) or None
+        json_result = _shared_request(
+            (root, cmd, args, generation),
+            lambda token: _run_doorstop_command(command, timeout, token),
+            token,
+        )
     if not json_result:
         return None
     parsed_results = json.loads(json_result.decode("utf-8"))
+
+    if cmd in CACHED_COMMANDS and root in _watchers:
+        with _cache_lock:
+            _results[key] = copy.deepcopy(parsed_results)
+        if cmd == "find_references" and "--locations" in args:
+            _remember_keyword_locations(root, args[-1], parsed_results)
+    elif cmd not in CACHED_COMMANDS:
+        written = _written_paths(cmd, parsed_results)
+        if written:
+            invalidate_items(root, written)
     return parsed_results
 
 
+class _Flight:
+    """
+    A backend request that is in progress, of which the output is
+    shared with all callers that ask the same while it runs.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.output = None
+        # Whether the token of the caller that runs the request was
+        # superseded, so that the other callers have to run it again
+        self.superseded = False
+
+
+# key -> _Flight of the requests in progress
+_flights = {}
+# key -> (time, output) of recently completed requests, least recent first
+_recent = OrderedDict()
+_flights_lock = threading.Lock()
+
+
+def _shared_request(key, run, token=None):
+    """
+    Returns the output of run(token), shared among concurrent callers with
+    the same key: only the first caller runs it, the others wait for its
+    output. Outputs are kept for a few seconds afterwards. The key holds the
+    cache generation, so changes to the tree start new requests.
+    """
+    while True:
+        with _flights_lock:
+            recent = _recent.get(key)
+            if recent and time.monotonic() - recent[0] < RECENT_RESULTS_TTL:
+                _recent.move_to_end(key)
+                return recent[1]
+            flight = _flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _flights[key] = _Flight()
+
+        if leader:
+            output = None
+            try:
+                output = run(token)
+            finally:
+                with _flights_lock:
+                    del _flights[key]
+                    if output is not None:
+                        _recent[key] = (time.monotonic(), output)
+                        while len(_recent) > RECENT_RESULTS_SIZE:
+                            _recent.popitem(last=False)
+                flight.output = output
+                flight.superseded = token is not None and not token.is_current()
+                flight.done.set()
+            return output
+
+        while not flight.done.wait(CANCEL_POLL_INTERVAL):
+            if token is not None and not token.is_current():
+                return None
+        if not flight.superseded:
+            return flight.output
+        if token is not None and not token.is_current():
+            return None
+
+
+def _from_index_file(root, cmd, args):
+    """
+    Answers a read command from the mapped index file of the root, without
+    a call to the backend. Returns None when the index file can't answer
+    it, for instance because it is missing or stale, or because the uid
+    isn't in it (the backend also matches uids case insensitively).
+    """
+    with _cache_lock:
+        index_file = _index_files.get(root)
+    if index_file is None:
+        return None
+    try:
+        if cmd == "item":
+            return index_file.item(args[0])
+        if cmd == "find_references" and len(args) == 1:
+            return index_file.find_references(args[0])
+        if cmd == "find_references" and args[0] == "--locations":
+            # The index file has no keyword locations, those
+            # are only known after the backend resolved them
+            return _with_keyword_locations(
+                root, args[-1], index_file.find_references(args[-1])
+            )
+        if cmd == "parents" and args[0] == "--item":
+            links = index_file.links(args[1])
+            if links is None:
+                return None
+            parents = [index_file.item(link) for link in links]
+            if None in parents:
+                # The backend also resolves links of which the case
+                # differs from the uid
+                return None
+            return parents
+    except (ValueError, struct.error) as e:
+        print("Doorstop: could not read index file: {}".format(e))
+    return None
+
+
+def _written_paths(cmd, result):
+    if not result:
+        return []
+    if cmd in ("add_reference", "link"):
+        return [result["path"]]
+    if cmd == "batch":
+        return [item["path"] for item in result["changed"]]
+    if cmd == "add_item":
+        return list(result.values())
+    return []
+
+
+def doorstop_stream(item, cmd, *args):
+    """
+    Like `doorstop`, but for commands that stream their results as JSON
+    lines. Yields each parsed line as soon as it is available.
+    """
+    root = item if isinstance(item, str) else doorstop_root(window=item.window)
+    for line in _stream_doorstop_command(["--root", root] + [cmd] + list(args)):
+        yield json.loads(line.decode("utf-8"))
+
+
 def region_to_reference(view, region):
     parsed = _parse_reference_region(view, region)
+    # While typing, the region might not (yet) be a mapping
+    if not isinstance(parsed, dict):
+        parsed = {}
     path = parsed.get("path")
     keyword = parsed.get("keyword")
 
@@ -206,35 +456,126 @@ def region_to_reference(view, region):
     if not path:
         return reference
 
-    root = Path(doorstop_root(view=view))
+    root = doorstop_root(view=view)
+    file = _resolve_path(root, path)
+    if not file:
+        return reference
+
+    reference.file = file
+    if not keyword:
+        return reference
+
+    location = _find_keyword(root, file, keyword)
+    if location:
+        reference.point, reference.row, reference.column = location
+
+    return reference
+
+
+def locate_reference(root, reference):
+    """
+    Returns an encoded position (file:row:column) for the given reference,
+    or just the file when the keyword can't be found. Returns None when
+    the path of the reference doesn't resolve.
+    """
+    file = _resolve_path(root, reference["path"])
+    if not file:
+        return None
+    if reference.get("keyword"):
+        location = _find_keyword(root, file, reference["keyword"])
+        if location:
+            return "{}:{}:{}".format(file, location[1], location[2])
+    return file
+
+
+def _resolve_path(root, path):
+    key = (root, path)
+    with _cache_lock:
+        if key in _resolved_paths:
+            return _resolved_paths[key]
+
     file = None
-    for globbed in root.rglob(path):
+    for globbed in Path(root).rglob(path):
         # One is all we need so break on first result
         file = globbed
         break
+    file = str(file) if file and file.is_file() else None
 
-    if not file or not file.is_file():
-        return reference
+    if root in _watchers:
+        with _cache_lock:
+            _resolved_paths[key] = file
+    return file
 
-    reference.file = str(file)
-    if not keyword:
-        return reference
 
-    with open(str(file), mode="r", encoding="utf-8") as fh:
+def _remember_keyword_locations(root, path, items):
+    """
+    Stores the keyword locations that the backend resolved for the file at
+    path (see `find_references --locations`), so that `_find_keyword`
+    doesn't have to read the file again for the same keywords, and so that
+    the index file can answer `find_references --locations` for the file.
+    """
+    file = str(Path(root) / path)
+    with _cache_lock:
+        for item in items:
+            keyword = item.get("keyword")
+            locations = item.get("locations")
+            if not keyword or locations is None:
+                continue
+            _keyword_occurrences[(file, keyword)] = locations
+            location = None
+            if locations:
+                first = locations[0]
+                line_start = first["offset"] - first["column"] + 1
+                location = (line_start, first["row"], first["column"])
+            _keyword_locations[(file, keyword)] = location
+        watcher = _watchers.get(root)
+    # Otherwise the next poll would take the file for a new one, and drop
+    # the locations again
+    if watcher is not None:
+        watcher.track(file)
+
+
+def _with_keyword_locations(root, path, items):
+    """
+    Adds the remembered keyword locations to the items that reference the
+    file at path. Returns None when the locations of one of the keywords
+    aren't known, so that the backend is asked instead.
+    """
+    file = str(Path(root) / path)
+    with _cache_lock:
+        for item in items:
+            keyword = item.get("keyword")
+            if not keyword:
+                continue
+            if (file, keyword) not in _keyword_occurrences:
+                return None
+            item["locations"] = copy.deepcopy(_keyword_occurrences[(file, keyword)])
+    return items
+
+
+def _find_keyword(root, file, keyword):
+    key = (file, keyword)
+    with _cache_lock:
+        if key in _keyword_locations:
+            return _keyword_locations[key]
+
+    location = None
+    with open(file, mode="r", encoding="utf-8") as fh:
         point = 0
         row = 1
         line = fh.readline()
         while line:
             if keyword in line:
-                reference.point = point
-                reference.row = row
-                reference.column = line.index(keyword) + 1
+                location = (point, row, line.index(keyword) + 1)
                 break
             point += len(line)
             row += 1
             line = fh.readline()
 
-    return reference
+    if root in _watchers:
+        with _cache_lock:
+            _keyword_locations[key] = location
+    return location
 
 
 def _parse_reference_region(view, region):
@@ -247,20 +588,1065 @@ def _parse_reference_region(view, region):
     return None
 
 
-def _run_doorstop_command(args):
+def _run_doorstop_command(args, timeout=None, token=None):
+    """
+    Runs the backend with the given arguments and returns its output.
+    Returns None when the command fails, takes longer than timeout
+    seconds or is superseded (see RequestToken).
+    """
     assert args
 
     global settings
+    backend = _in_process_backend()
+    if backend is not None:
+        return _run_in_process(backend, args, timeout, token)
+    if settings.get(Setting().BACKEND) == "worker":
+        return _backend_worker(args[1]).request(args, timeout, token)
+
     interpreter = settings.get(Setting().INTERPRETER)
     assert interpreter is not None
     # TODO: maybe I could use the 'find_resources' method here from sublime
     script = Path(__file__).parent / "doorstop_cli" / "doorstop_cli.py"
     assert script.is_file()
 
+    process = subprocess.Popen(
+        [interpreter, str(script)] + args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    if token is not None and not token.track(process):
+        return None
     try:
-        result = subprocess.check_output([interpreter, str(script)] + args)
-    except subprocess.CalledProcessError as e:
-        print("stderr: {}".format(e.output))
-        print("error: {}".format(e))
+        result, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        print("Doorstop: {} timed out after {} s".format(args[2], timeout))
+        return None
+    finally:
+        if token is not None:
+            token.untrack(process)
+
+    if token is not None and not token.is_current():
+        return None
+    if process.returncode != 0:
+        print("stderr: {}".format(stderr))
+        print("error: exit status {}".format(process.returncode))
         return None
     return result
+
+
+def _stream_doorstop_command(args):
+    assert args
+
+    backend = _in_process_backend()
+    if backend is not None:
+        yield from _stream_in_process(backend, args)
+        return
+
+    global settings
+    interpreter = settings.get(Setting().INTERPRETER)
+    assert interpreter is not None
+    script = Path(__file__).parent / "doorstop_cli" / "doorstop_cli.py"
+    assert script.is_file()
+
+    # stderr goes to a file, since a full stderr pipe that isn't read
+    # while stdout is would block the backend
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(
+            [interpreter, str(script)] + args,
+            stdout=subprocess.PIPE,
+            stderr=stderr,
+        )
+        for line in process.stdout:
+            if line.strip():
+                yield line
+        process.communicate()
+        if process.returncode != 0:
+            stderr.seek(0)
+            print("stderr: {}".format(stderr.read()))
+            print("error: exit status {}".format(process.returncode))
+
+
+# The doorstop_cli module imported into the plugin host
+_cli = None
+_cli_lock = threading.Lock()
+# The doorstop_cli module when the in-process backend can use it (doorstop
+# imports), False when that failed
+_in_process = None
+# The interpreter and site packages settings with which _in_process was
+# determined, it is determined again when they change
+_in_process_settings = None
+_in_process_lock = threading.Lock()
+# Threads that run the commands of the in-process backend, started with
+# the first command
+_executor = None
+# Seconds between checks whether an in-process command was superseded
+CANCEL_POLL_INTERVAL = 0.05
+
+
+def _cli_module():
+    """
+    Imports doorstop_cli.py into the plugin host, without doorstop. The
+    in-process backend runs its commands, and DoorstopIndexFile reads the
+    index file with its layout.
+    """
+    global _cli
+    with _cli_lock:
+        if _cli is None:
+            script = Path(__file__).parent / "doorstop_cli" / "doorstop_cli.py"
+            spec = importlib.util.spec_from_file_location("doorstop_cli", str(script))
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            _cli = module
+        return _cli
+
+
+def _in_process_backend():
+    """
+    Returns the doorstop_cli module, imported into the plugin host, when
+    the in-process backend is selected and doorstop can be imported (from
+    the configured site packages). Returns None otherwise, so that
+    commands run with the python interpreter instead.
+    """
+    global settings
+    global _in_process
+    global _in_process_settings
+    if settings.get(Setting().BACKEND) != "in_process":
+        # Try again when it is selected again
+        _in_process = None
+        return None
+    site_packages = settings.get(Setting().SITE_PACKAGES) or []
+    current = (settings.get(Setting().INTERPRETER), tuple(site_packages))
+    with _in_process_lock:
+        if _in_process is None or _in_process_settings != current:
+            _in_process_settings = current
+            for path in site_packages:
+                if path not in sys.path:
+                    sys.path.append(path)
+            try:
+                module = _cli_module()
+                module.import_doorstop()
+                module.RESIDENT_INDEXES = settings.get(Setting().MAX_BACKENDS) or 1
+                if module.snapshots is None:
+                    # Reads run concurrently with writes on the executor
+                    module.snapshots = module.Snapshots()
+                _in_process = module
+            except Exception as e:
+                print("Doorstop: in-process backend not available: {}".format(e))
+                _in_process = False
+        return _in_process or None
+
+
+def _in_process_executor():
+    global _executor
+    with _in_process_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=4)
+        return _executor
+
+
+def stop_in_process():
+    """
+    Shuts down the threads of the in-process backend. Commands that are
+    still running finish in the background.
+    """
+    global _executor
+    with _in_process_lock:
+        executor = _executor
+        _executor = None
+    if executor is not None:
+        executor.shutdown(wait=False)
+
+
+def _run_in_process(backend, args, timeout=None, token=None):
+    """
+    Runs the command on a thread of the executor. Threads can't be killed,
+    so a command that times out or is superseded keeps running, but its
+    result is ignored.
+    """
+    out = io.StringIO()
+    future = _in_process_executor().submit(backend.main, args, out)
+    waited = 0
+    while True:
+        if token is not None and not token.is_current():
+            return None
+        try:
+            future.result(timeout=CANCEL_POLL_INTERVAL)
+            break
+        except TimeoutError:
+            waited += CANCEL_POLL_INTERVAL
+            if timeout and waited >= timeout:
+                print("Doorstop: {} timed out after {} s".format(args[2], timeout))
+                return None
+        except (Exception, SystemExit) as e:
+            print("error: {}".format(e))
+            return None
+    if token is not None and not token.is_current():
+        return None
+    return out.getvalue().encode("utf-8")
+
+
+class DoorstopWorker:
+    """
+    Long running backend process for one root (`doorstop_cli.py serve`),
+    which keeps the items of the root loaded between requests. Requests
+    are answered in order; the answers to abandoned requests are dropped.
+    """
+
+    def __init__(self, root):
+        global settings
+        interpreter = settings.get(Setting().INTERPRETER)
+        assert interpreter is not None
+        script = Path(__file__).parent / "doorstop_cli" / "doorstop_cli.py"
+        self.root = root
+        self.process = subprocess.Popen(
+            [interpreter, str(script), "--root", root, "serve"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        self.lock = threading.Lock()
+        # request id -> _Flight of the requests that are waited for
+        self.pending = {}
+        self.next_id = 0
+        self.last_used = time.monotonic()
+        self.rss = None
+        # Whether the worker is stopped once its pending requests are
+        # answered, because it uses too much memory
+        self.retired = False
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        for line in self.process.stdout:
+            try:
+                response = json.loads(line.decode("utf-8"))
+                request_id = response["id"]
+            except (ValueError, TypeError, KeyError):
+                # Printed by something else than serve, like doorstop
+                print("Doorstop: unexpected backend output: {}".format(line[:200]))
+                continue
+            self.rss = response.get("rss")
+            with self.lock:
+                flight = self.pending.pop(request_id, None)
+            if flight is not None:
+                flight.output = response
+                flight.done.set()
+            self._retire_if_over_memory_limit()
+
+        # The process ended, so no more answers will come
+        with self.lock:
+            flights = list(self.pending.values())
+            self.pending.clear()
+        for flight in flights:
+            flight.done.set()
+
+    def _retire_if_over_memory_limit(self):
+        """
+        Replaces the worker when it alone uses more memory than
+        backend_memory_limit (MB): new requests start another worker, and
+        this one stops when its pending requests are answered.
+        """
+        global settings
+        if not self.retired:
+            memory_limit = settings.get(Setting().BACKEND_MEMORY)
+            if not memory_limit or (self.rss or 0) <= memory_limit:
+                return
+        with _workers_lock:
+            if _workers.get(self.root) is self:
+                del _workers[self.root]
+        with self.lock:
+            self.retired = True
+            if not self.pending:
+                self.stop()
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def request(self, args, timeout=None, token=None):
+        """
+        Like _run_doorstop_command, but answered by this worker. A request
+        that times out stops the worker, since it might be stuck.
+        """
+        flight = _Flight()
+        with self.lock:
+            retired = self.retired
+            if not retired:
+                self.next_id += 1
+                request_id = self.next_id
+                self.pending[request_id] = flight
+                self.last_used = time.monotonic()
+                try:
+                    line = json.dumps({"id": request_id, "args": args}) + "\n"
+                    self.process.stdin.write(line.encode("utf-8"))
+                    self.process.stdin.flush()
+                except OSError as e:
+                    del self.pending[request_id]
+                    print("Doorstop: backend for {} stopped: {}".format(self.root, e))
+                    return None
+        if retired:
+            return _backend_worker(self.root).request(args, timeout, token)
+
+        waited = 0
+        while not flight.done.wait(CANCEL_POLL_INTERVAL):
+            if token is not None and not token.is_current():
+                with self.lock:
+                    self.pending.pop(request_id, None)
+                return None
+            waited += CANCEL_POLL_INTERVAL
+            if timeout and waited >= timeout:
+                print("Doorstop: {} timed out after {} s".format(args[2], timeout))
+                self.stop()
+                return None
+
+        response = flight.output
+        if response is None:
+            return None
+        if response["error"]:
+            print("error: {}".format(response["error"]))
+            return None
+        return response["output"].encode("utf-8")
+
+    def stop(self):
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+
+
+# root -> DoorstopWorker, least recently used first
+_workers = OrderedDict()
+_workers_lock = threading.Lock()
+# Seconds between checks for idle workers
+IDLE_CHECK_INTERVAL = 60
+
+
+def _backend_worker(root):
+    """
+    Returns the worker for the root, starting one when needed. Keeps at
+    most max_backends workers, and fewer when together they use more
+    memory than backend_memory_limit (MB): the least recently used
+    workers are stopped first.
+    """
+    global settings
+    with _workers_lock:
+        worker = _workers.pop(root, None)
+        if worker is None or not worker.is_alive():
+            worker = DoorstopWorker(root)
+            if not _workers:
+                sublime.set_timeout_async(
+                    _stop_idle_workers, IDLE_CHECK_INTERVAL * 1000
+                )
+        _workers[root] = worker
+
+        evicted = []
+        limit = settings.get(Setting().MAX_BACKENDS) or 1
+        memory_limit = settings.get(Setting().BACKEND_MEMORY)
+        while len(_workers) > 1:
+            memory = sum(other.rss or 0 for other in _workers.values())
+            if len(_workers) <= limit and (not memory_limit or memory <= memory_limit):
+                break
+            evicted.append(_workers.popitem(last=False)[1])
+    for other in evicted:
+        other.stop()
+    return worker
+
+
+def _stop_idle_workers():
+    """
+    Stops the workers that weren't used for backend_idle_timeout seconds.
+    Runs periodically while there are workers.
+    """
+    global settings
+    idle_timeout = settings.get(Setting().BACKEND_IDLE)
+    now = time.monotonic()
+    with _workers_lock:
+        idle = [
+            root
+            for root, worker in _workers.items()
+            if idle_timeout and now - worker.last_used > idle_timeout
+        ]
+        stopped = [_workers.pop(root) for root in idle]
+        running = bool(_workers)
+    for worker in stopped:
+        worker.stop()
+    if running:
+        sublime.set_timeout_async(_stop_idle_workers, IDLE_CHECK_INTERVAL * 1000)
+
+
+def stop_workers():
+    with _workers_lock:
+        workers = list(_workers.values())
+        _workers.clear()
+    for worker in workers:
+        worker.stop()
+
+
+class _LineQueue(io.TextIOBase):
+    """
+    Output stream for in-process commands that puts each line that is
+    written into a queue, so that it can be read while the command runs.
+    """
+
+    def __init__(self):
+        self.lines = queue.Queue()
+        self.pending = ""
+
+    def write(self, text):
+        lines = (self.pending + text).split("\n")
+        self.pending = lines.pop()
+        for line in lines:
+            self.lines.put(line)
+        return len(text)
+
+    def close_lines(self):
+        if self.pending:
+            self.lines.put(self.pending)
+        self.lines.put(None)
+
+
+def _stream_in_process(backend, args):
+    out = _LineQueue()
+
+    def run():
+        try:
+            backend.main(args, out)
+        except (Exception, SystemExit) as e:
+            print("error: {}".format(e))
+        finally:
+            out.close_lines()
+
+    _in_process_executor().submit(run)
+    line = out.lines.get()
+    while line is not None:
+        if line.strip():
+            yield line.encode("utf-8")
+        line = out.lines.get()
+
+
+# Caches that are kept up to date by the watchers
+_cache_lock = threading.Lock()
+# (root, cmd, args) -> parsed result of read commands
+_results = {}
+# (root, reference path) -> resolved file (or None)
+_resolved_paths = {}
+# (file, keyword) -> (point, row, column) (or None)
+_keyword_locations = {}
+# (file, keyword) -> all locations that the backend resolved, see
+# _remember_keyword_locations
+_keyword_occurrences = {}
+# root -> {uid: set of referenced paths} for all items with references
+_referenced_paths = {}
+# root -> DoorstopIndexFile, only while it matches the item files
+_index_files = {}
+# root -> DoorstopWatcher
+_watchers = {}
+# Incremented each time cached results are invalidated
+generation = 0
+# Callbacks that get called with each ChangeSet
+change_listeners = []
+
+
+class ChangeSet:
+    """
+    Files that were created, modified or deleted under a doorstop root
+    between two snapshots of a watcher.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.items = set()
+        self.files = set()
+        self.created = set()
+        self.deleted = set()
+        # Filled in when the change set is used to invalidate the caches
+        self.uids = set()
+        self.paths = set()
+
+    def __bool__(self):
+        return bool(self.items or self.files)
+
+
+class DoorstopWatcher:
+    """
+    Watches a doorstop root by polling stat snapshots of all item files
+    and of the files that are referenced by items. Differences between
+    snapshots are reported as ChangeSets. Polls run on a thread of their
+    own, since they take long on big trees; the changes are reported on
+    the async thread.
+    """
+
+    # Number of polls after which the document folders are looked up again
+    REDISCOVER_POLLS = 15
+
+    def __init__(self, root, interval, on_change):
+        self.root = root
+        self.interval = interval
+        self.on_change = on_change
+        self.stopped = threading.Event()
+        self.polls = 0
+        self.document_dirs = []
+        self.lock = threading.Lock()
+        self.snapshot = {}
+        # Files that were tracked while a snapshot was taken
+        self.tracked = set()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self):
+        self.document_dirs = self._find_document_dirs()
+        self._refresh()
+        while not self.stopped.wait(self.interval):
+            self.poll()
+
+    def poll(self):
+        self.polls += 1
+        if self.polls % self.REDISCOVER_POLLS == 0:
+            self.document_dirs = self._find_document_dirs()
+        changes = self._refresh()
+        if changes:
+            sublime.set_timeout_async(lambda: self._report(changes), 0)
+
+    def _refresh(self):
+        """
+        Takes a new snapshot and returns the ChangeSet since the last one.
+        """
+        with self.lock:
+            self.tracked.clear()
+        snapshot = self._take_snapshot()
+        with self.lock:
+            for path in self.tracked:
+                if path not in snapshot and path in self.snapshot:
+                    snapshot[path] = self.snapshot[path]
+            previous = self.snapshot
+            self.snapshot = snapshot
+
+        changes = ChangeSet(self.root)
+        for path in snapshot.keys() | previous.keys():
+            stamp = snapshot.get(path)
+            if stamp == previous.get(path):
+                continue
+            if path not in previous:
+                changes.created.add(path)
+            elif stamp is None:
+                changes.deleted.add(path)
+            if is_doorstop_item_file(path):
+                changes.items.add(path)
+            else:
+                changes.files.add(path)
+        return changes
+
+    def _report(self, changes):
+        if self.stopped.is_set():
+            return
+        try:
+            self.on_change(changes)
+        except Exception as e:
+            print("Doorstop: could not process changes: {}".format(e))
+
+    def track(self, path):
+        """
+        Adds a file that just started to be watched to the current snapshot.
+        """
+        with self.lock:
+            if path not in self.snapshot:
+                self._stat(self.snapshot, path)
+            self.tracked.add(path)
+
+    def _find_document_dirs(self):
+        result = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if d not in EXCLUDE_DIRNAMES]
+            if ".doorstop.yml" in filenames:
+                result.append(dirpath)
+        return result
+
+    def _take_snapshot(self):
+        snapshot = {}
+        for folder in self.document_dirs:
+            for dirpath, dirnames, filenames in os.walk(folder):
+                # Nested documents are walked for their own folder
+                dirnames[:] = [
+                    d
+                    for d in dirnames
+                    if d not in EXCLUDE_DIRNAMES
+                    and not os.path.isfile(os.path.join(dirpath, d, ".doorstop.yml"))
+                ]
+                for filename in filenames:
+                    if filename.endswith(".yml"):
+                        self._stat(snapshot, os.path.join(dirpath, filename))
+
+        with _cache_lock:
+            files = {
+                file for (root, _), file in _resolved_paths.items() if root == self.root
+            }
+            files.update(file for file, _ in _keyword_locations)
+        for file in files:
+            if file:
+                self._stat(snapshot, file)
+        return snapshot
+
+    def _stat(self, snapshot, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+
+
+class DoorstopIndexFile:
+    """
+    Read-only view on the binary index file that the backend publishes,
+    in the layout of write_index_file in doorstop_cli.py. The file is
+    memory mapped and read through a memoryview, so lookups only copy the
+    strings they return.
+    """
+
+    def __init__(self, path):
+        layout = _cli_module()
+        self.ITEM = layout.INDEX_ITEM
+        self.LINK = layout.INDEX_LINK
+        self.PATH = layout.INDEX_PATH
+        self.REFERENCE = layout.INDEX_REFERENCE
+        self.NO_KEYWORD = layout.NO_KEYWORD
+        with open(path, mode="rb") as fh:
+            self.map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        (
+            magic,
+            version,
+            self.item_count,
+            self.path_count,
+            self.items,
+            self.links_offset,
+            self.paths,
+            self.references,
+            self.strings,
+        ) = layout.INDEX_HEADER.unpack_from(self.view, 0)
+        if magic != layout.INDEX_MAGIC or version != layout.INDEX_FILE_VERSION:
+            self.view.release()
+            self.map.close()
+            raise ValueError("Unsupported index file: {}".format(path))
+
+    def _bytes(self, offset, length):
+        start = self.strings + offset
+        return self.view[start : start + length]
+
+    def _string(self, offset, length):
+        return str(self._bytes(offset, length), "utf-8")
+
+    def _search(self, key, count, section, record):
+        """
+        Returns the fields of the record in a sorted section of which
+        the first string equals key, or None.
+        """
+        key = key.encode("utf-8")
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            fields = record.unpack_from(self.view, section + middle * record.size)
+            value = self._bytes(fields[0], fields[1])
+            if value == key:
+                return fields
+            # A memoryview has no ordering; one byte past the key is
+            # enough to order a longer value
+            if value[: len(key) + 1].tobytes() < key:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def _item_dict(self, fields):
+        return {
+            "uid": self._string(fields[0], fields[1]),
+            "path": self._string(fields[2], fields[3]),
+            "text": self._string(fields[4], fields[5]),
+        }
+
+    def item(self, uid):
+        fields = self._search(uid, self.item_count, self.items, self.ITEM)
+        return None if fields is None else self._item_dict(fields)
+
+    def links(self, uid):
+        fields = self._search(uid, self.item_count, self.items, self.ITEM)
+        if fields is None:
+            return None
+        first, count = fields[6], fields[7]
+        result = []
+        for number in range(first, first + count):
+            offset, length = self.LINK.unpack_from(
+                self.view, self.links_offset + number * self.LINK.size
+            )
+            result.append(self._string(offset, length))
+        return result
+
+    def find_references(self, path):
+        fields = self._search(path, self.path_count, self.paths, self.PATH)
+        if fields is None:
+            return []
+        first, count = fields[2], fields[3]
+        result = []
+        for number in range(first, first + count):
+            item, offset, length = self.REFERENCE.unpack_from(
+                self.view, self.references + number * self.REFERENCE.size
+            )
+            entry = self._item_dict(
+                self.ITEM.unpack_from(self.view, self.items + item * self.ITEM.size)
+            )
+            if length == self.NO_KEYWORD:
+                entry["keyword"] = None
+            else:
+                entry["keyword"] = self._string(offset, length)
+            result.append(entry)
+        return result
+
+
+def refresh_index_file(root):
+    """
+    Asks the backend to publish a fresh index file for the root and maps
+    it. The new file is dropped when items changed in the meantime; the
+    invalidation that dropped the old one then requested another one.
+    """
+    started = generation
+    result = doorstop(root, "publish_index")
+    if not result or not result.get("path"):
+        return
+    try:
+        index_file = DoorstopIndexFile(result["path"])
+    except (OSError, ValueError) as e:
+        print("Doorstop: could not map index file: {}".format(e))
+        return
+    with _cache_lock:
+        if generation == started and root in _watchers:
+            _index_files[root] = index_file
+
+
+def _request_index_file(root):
+    sublime.set_timeout_async(lambda: refresh_index_file(root), 0)
+
+
+def watch(root):
+    """
+    Starts watching the given root, unless it is already watched or
+    watching is disabled in the settings.
+    """
+    global settings
+    if not root or root in _watchers:
+        return
+    interval = settings.get(Setting().WATCH_INTERVAL)
+    if not interval or interval <= 0:
+        return
+    watcher = DoorstopWatcher(root, interval, _process_changes)
+    _watchers[root] = watcher
+    watcher.start()
+    _request_index_file(root)
+
+
+def stop_watching():
+    for watcher in _watchers.values():
+        watcher.stop()
+    _watchers.clear()
+    with _cache_lock:
+        _results.clear()
+        _resolved_paths.clear()
+        _keyword_locations.clear()
+        _keyword_occurrences.clear()
+        _referenced_paths.clear()
+        # Not closed explicitly, lookups in other threads might still use
+        # them; the mappings are closed once they're garbage collected
+        _index_files.clear()
+    with _flights_lock:
+        _recent.clear()
+
+
+def is_watched(root):
+    return root in _watchers
+
+
+def is_referenced(root, path):
+    """
+    Returns whether any item references the given path. The referenced
+    paths of all items are fetched once and then kept up to date with
+    the changes that the watcher reports. Returns True when that isn't
+    possible, so that callers ask the backend instead.
+    """
+    if not is_watched(root):
+        return True
+    with _cache_lock:
+        by_uid = _referenced_paths.get(root)
+    if by_uid is None:
+        result = doorstop(root, "referenced_paths")
+        if result is None:
+            return True
+        by_uid = {uid: set(paths) for uid, paths in result.items()}
+        with _cache_lock:
+            by_uid = _referenced_paths.setdefault(root, by_uid)
+    with _cache_lock:
+        return any(path in paths for paths in by_uid.values())
+
+
+def _process_changes(changes):
+    uids, paths = invalidate_items(changes.root, changes.items)
+    changes.uids.update(uids)
+    changes.paths.update(paths)
+    invalidate_files(changes.files, changes.created | changes.deleted)
+    for listener in change_listeners:
+        listener(changes)
+
+
+def _read_item_file(path):
+    try:
+        with open(path, mode="r", encoding="utf-8") as fh:
+            return yaml.load(fh, Loader=yaml.SafeLoader) or {}
+    except Exception:
+        return {}
+
+
+def invalidate_items(root, paths):
+    """
+    Drops the cached results that are affected by changes to the given
+    item files. Returns the uids and the referenced paths of which the
+    cached results were affected.
+    """
+    global generation
+    with _cache_lock:
+        generation += 1
+        _index_files.pop(root, None)
+    if root in _watchers:
+        _request_index_file(root)
+
+    uids = set()
+    referenced = set()
+    for path in paths:
+        uid = Path(path).stem
+        data = _read_item_file(path)
+        uids.add(uid)
+        for link in data.get("links") or []:
+            uids.update(link.keys() if isinstance(link, dict) else [str(link)])
+        item_paths = {
+            reference["path"]
+            for reference in data.get("references") or []
+            if isinstance(reference, dict) and reference.get("path")
+        }
+        referenced.update(item_paths)
+
+        with _cache_lock:
+            by_uid = _referenced_paths.get(root)
+            if by_uid is not None:
+                referenced.update(by_uid.pop(uid, ()))
+                if item_paths:
+                    by_uid[uid] = item_paths
+
+    changed = {Path(path).stem for path in paths}
+    affected_uids = set()
+    affected_paths = set()
+    with _cache_lock:
+        for key, result in list(_results.items()):
+            result_root, cmd, args = key
+            if result_root != root:
+                continue
+            arg = args[-1] if args else None
+            result_uids = {entry.get("uid") for entry in _as_list(result) if entry}
+            if cmd == "find_references":
+                if arg in referenced or result_uids & changed:
+                    del _results[key]
+                    affected_paths.add(arg)
+            elif cmd == "item":
+                if arg in changed:
+                    del _results[key]
+                    affected_uids.add(arg)
+            elif arg in uids or result_uids & changed:
+                del _results[key]
+                affected_uids.add(arg)
+    return affected_uids | uids, affected_paths | referenced
+
+
+def invalidate_files(files, created_or_deleted=()):
+    """
+    Drops the cached keyword locations for the given files (also those in
+    cached find_references results), and the cached path resolutions that
+    might resolve differently now that files have been created or deleted.
+    """
+    global generation
+    generation += 1
+
+    names = {Path(file).name for file in created_or_deleted}
+    with _cache_lock:
+        for key in list(_keyword_locations):
+            if key[0] in files:
+                del _keyword_locations[key]
+        for key in list(_keyword_occurrences):
+            if key[0] in files:
+                del _keyword_occurrences[key]
+        for key in list(_results):
+            root, cmd, args = key
+            if "--locations" in args and str(Path(root) / args[-1]) in files:
+                del _results[key]
+        for key, file in list(_resolved_paths.items()):
+            if file in files or Path(key[1]).name in names:
+                del _resolved_paths[key]
+
+
+def _as_list(result):
+    if isinstance(result, list):
+        return result
+    return [result]
+
+
+class RequestToken:
+    """
+    Identifies the latest request of a view for some purpose, like finding
+    the referenced locations of the file. Starting a new request for the
+    same view and purpose supersedes the previous one, as does leaving or
+    closing the view: the backend calls of a superseded request are killed,
+    and its late results are dropped instead of applied.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.processes = set()
+
+    def is_current(self):
+        return not self.cancelled
+
+    def track(self, process):
+        """
+        Registers a running backend process to kill on cancel. Kills it
+        right away and returns False when the token was already cancelled.
+        """
+        with self.lock:
+            if not self.cancelled:
+                self.processes.add(process)
+                return True
+        process.kill()
+        process.communicate()
+        return False
+
+    def untrack(self, process):
+        with self.lock:
+            self.processes.discard(process)
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            processes = list(self.processes)
+            self.processes.clear()
+        for process in processes:
+            try:
+                process.kill()
+            except OSError:
+                pass
+
+
+# (view id, purpose) -> RequestToken of the latest request
+_requests = {}
+_requests_lock = threading.Lock()
+
+
+def new_request(view, purpose):
+    """
+    Returns a RequestToken for a new request of the view, which
+    supersedes the previous request for the same purpose.
+    """
+    token = RequestToken()
+    with _requests_lock:
+        previous = _requests.get((view.id(), purpose))
+        _requests[(view.id(), purpose)] = token
+    if previous is not None:
+        previous.cancel()
+    return token
+
+
+def cancel_requests(view):
+    """
+    Supersedes all requests of the view, when the user left or closed it.
+    """
+    with _requests_lock:
+        keys = [key for key in _requests if key[0] == view.id()]
+        tokens = [_requests.pop(key) for key in keys]
+    for token in tokens:
+        token.cancel()
+
+
+class BufferState:
+    """
+    Results that are computed for a buffer and shared by all views into
+    that buffer, so that clones and splits don't repeat the same work.
+    A result is valid until the buffer or the cached results change.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = {}
+        # key -> (stamp, Event) of the results that are being computed
+        self.computing = {}
+
+    def get(self, view, key, compute, force=False, token=None):
+        stamp = (view.change_count(), generation)
+        while True:
+            with self.lock:
+                if not force and key in self.results:
+                    result_stamp, result = self.results[key]
+                    if result_stamp == stamp:
+                        return result
+                running = self.computing.get(key)
+                if running is None or running[0] != stamp:
+                    done = threading.Event()
+                    self.computing[key] = (stamp, done)
+                    break
+            # Another view of the buffer is computing the same result, wait
+            # for it instead of computing it again. The lock isn't held
+            # while computing, since that calls the backend.
+            running[1].wait()
+            force = False
+
+        result = None
+        try:
+            result = compute()
+        finally:
+            with self.lock:
+                # The result of a superseded request might be incomplete,
+                # and None means that a backend call failed: compute it
+                # again the next time instead of keeping that
+                if result is not None and (token is None or token.is_current()):
+                    self.results[key] = (stamp, result)
+                if self.computing.get(key) == (stamp, done):
+                    del self.computing[key]
+            done.set()
+        if token is not None and not token.is_current():
+            return None
+        return result
+
+    def drop(self, key):
+        with self.lock:
+            self.results.pop(key, None)
+
+
+# buffer id -> BufferState
+_buffer_states = {}
+_buffer_states_lock = threading.Lock()
+
+
+def buffer_state(view):
+    with _buffer_states_lock:
+        return _buffer_states.setdefault(view.buffer_id(), BufferState())
+
+
+def release_buffer_state(view):
+    """
+    Drops the state of the buffer of the view, when no other
+    views into that buffer are left.
+    """
+    try:
+        others = [v for v in view.buffer().views() if v.id() != view.id()]
+    except Exception:
+        others = []
+    if others:
+        return
+    with _buffer_states_lock:
+        _buffer_states.pop(view.buffer_id(), None)